@@ -2,13 +2,104 @@
 title: 引用包装与索引清理器
 author: Roo
 description: 这个过滤器将AI搜索到的来源列表用反引号包裹起来，并过滤掉引用来源列表以外文本中的索引标签[]
-version: 1.2.0
+version: 1.3.0
 license: MIT
 """
 
-from pydantic import BaseModel
+from collections import OrderedDict
+from pydantic import BaseModel, Field
 from typing import Optional
+import json
 import re
+import time
+
+
+# 单次扫描同时匹配引用来源列表（<details>块，可能已被反引号包裹）和索引标签，
+# 引用来源列表排在前面，因此列表内部的索引标签会随整个列表一起匹配而被保留
+CITATION_PATTERN = re.compile(
+    r'(?:```\n)?(<details>.*?</details>)(?:\n```)?|<sup>\[\d+\]</sup>|\[\d+\]',
+    re.DOTALL,
+)
+
+
+class StreamCitationCleaner:
+    """
+    流式引用清理器 - 逐块移除索引标签并包裹<details>块，
+    只保留可能被截断的标签前缀作为前瞻缓冲，每个流占用O(1)额外内存
+    """
+
+    # <details>外需要处理的标签
+    OUTSIDE_PATTERN = re.compile(r'<sup>\[\d+\]</sup>|\[\d+\]|<details>')
+    # 可能被截断在块末尾的标签前缀
+    PARTIAL_PATTERN = re.compile(
+        r'(?:<(?:s(?:u(?:p(?:>(?:\[(?:\d+(?:\](?:<(?:/(?:s(?:u(?:p)?)?)?)?)?)?)?)?)?)?)?)?'
+        r'|\[\d*'
+        r'|<(?:d(?:e(?:t(?:a(?:i(?:l(?:s)?)?)?)?)?)?)?)\Z'
+    )
+    CLOSE_TAG = '</details>'
+    MAX_LOOKAHEAD = 32
+
+    def __init__(self):
+        self.inside = False
+        self.pending = ""
+
+    def _split_partial(self, text: str) -> tuple:
+        """将文本拆分为可以输出的部分和需要留待下一块判断的前缀"""
+        tail_start = max(0, len(text) - self.MAX_LOOKAHEAD)
+        if self.inside:
+            for i in range(max(tail_start, len(text) - len(self.CLOSE_TAG) + 1), len(text)):
+                if self.CLOSE_TAG.startswith(text[i:]):
+                    return text[:i], text[i:]
+            return text, ""
+        for i in range(tail_start, len(text)):
+            if text[i] in '<[' and self.PARTIAL_PATTERN.match(text, i):
+                return text[:i], text[i:]
+        return text, ""
+
+    def feed(self, chunk: str, final: bool = False) -> str:
+        """处理一块文本，返回可以立即输出的内容；final为True时不再保留前瞻缓冲"""
+        text = self.pending + chunk
+        output = []
+        pos = 0
+        while True:
+            if self.inside:
+                end = text.find(self.CLOSE_TAG, pos)
+                if end < 0:
+                    break
+                output.append(text[pos:end])
+                output.append('</details>\n```')
+                pos = end + len(self.CLOSE_TAG)
+                self.inside = False
+            else:
+                match = self.OUTSIDE_PATTERN.search(text, pos)
+                if not match:
+                    break
+                start = match.start()
+                # <sup>[n]后的</sup>可能还未到达，留待下一块整体匹配
+                if (
+                    not final
+                    and text.startswith('<sup>', start - 5, start)
+                    and match.group()[0] == '['
+                    and '</sup>'.startswith(text[match.end():])
+                ):
+                    output.append(text[pos:start - 5])
+                    self.pending = text[start - 5:]
+                    return "".join(output)
+                output.append(text[pos:start])
+                if match.group() == '<details>':
+                    output.append('```\n<details>')
+                    self.inside = True
+                pos = match.end()
+        if final:
+            ready, self.pending = text[pos:], ""
+        else:
+            ready, self.pending = self._split_partial(text[pos:])
+        output.append(ready)
+        return "".join(output)
+
+    def flush(self) -> str:
+        """流结束时输出剩余的缓冲内容"""
+        return self.feed("", final=True)
 
 class Filter:
     """
@@ -17,11 +108,17 @@ class Filter:
     
     class Valves(BaseModel):
         """过滤器的配置选项"""
-        pass
+        stream_cleanup: bool = Field(
+            default=True, description="在流式输出过程中实时清理索引标签并包裹引用来源列表"
+        )
     
     def __init__(self):
         """初始化过滤器"""
         self.valves = self.Valves()
+        # 已处理过的消息内容，按最近使用排序
+        self.processed: "OrderedDict[str, None]" = OrderedDict()
+        # 每个正在输出的消息对应一个流式清理器
+        self.cleaners: "OrderedDict[tuple, StreamCitationCleaner]" = OrderedDict()
     
     def inlet(self, body: dict, __user__: Optional[dict] = None) -> dict:
         """
@@ -29,10 +126,36 @@ class Filter:
         """
         return body
     
-    def stream(self, event: dict) -> dict:
+    def stream(self, event: dict, __metadata__: Optional[dict] = None) -> dict:
         """
-        实时流处理 - 在这个过滤器中不需要修改流
+        实时流处理 - 逐块移除索引标签并包裹引用来源列表
         """
+        if not self.valves.stream_cleanup:
+            return event
+        try:
+            choice = event["choices"][0]
+            delta = choice.get("delta") or {}
+        except (KeyError, IndexError, TypeError):
+            return event
+
+        metadata = __metadata__ or {}
+        key = (metadata.get("chat_id"), metadata.get("message_id"))
+        # 没有会话和消息ID时无法区分并发的流，交给outlet统一处理
+        if None in key:
+            return event
+        cleaner = self.cleaners.get(key)
+        if cleaner is None:
+            cleaner = self.cleaners[key] = StreamCitationCleaner()
+            # 防止未正常结束的流无限累积
+            while len(self.cleaners) > 256:
+                self.cleaners.popitem(last=False)
+
+        content = delta.get("content")
+        if isinstance(content, str):
+            delta["content"] = cleaner.feed(content)
+        if choice.get("finish_reason"):
+            delta["content"] = (delta.get("content") or "") + cleaner.flush()
+            self.cleaners.pop(key, None)
         return event
     
     def outlet(self, body: dict, __user__: Optional[dict] = None) -> dict:
@@ -46,62 +169,56 @@ class Filter:
         # 遍历所有消息
         for message in body["messages"]:
             # 只处理助手的消息
-            if message.get("role") == "assistant" and "content" in message:
+            if message.get("role") == "assistant" and isinstance(message.get("content"), str):
                 content = message["content"]
-                
-                # 查找引用来源列表
-                # 匹配任何以<details>开头并以</details>结尾的内容
-                citation_pattern = r'(<details>.*?</details>)'
-                
-                # 使用正则表达式查找引用来源列表
-                citation_matches = list(re.finditer(citation_pattern, content, re.DOTALL))
-                
-                # 如果找到了引用来源列表
-                if citation_matches:
-                    # 创建一个新的内容字符串
-                    new_content = ""
-                    last_end = 0
-                    
-                    # 处理每个引用来源列表及其前后的文本
-                    for match in citation_matches:
-                        # 获取当前匹配的起始和结束位置
-                        start, end = match.span()
-                        
-                        # 处理引用来源列表前的文本（移除索引标签[]）
-                        before_text = content[last_end:start]
-                        # 使用正则表达式移除索引标签
-                        # 匹配HTML格式的上标索引标签 <sup>[数字]</sup>
-                        before_text = re.sub(r'<sup>\[\d+\]</sup>', '', before_text)
-                        # 匹配纯文本格式的索引标签 [数字]
-                        before_text = re.sub(r'\[\d+\]', '', before_text)
-                        
-                        # 添加处理后的文本到新内容
-                        new_content += before_text
-                        
-                        # 获取引用来源列表
-                        citation_list = match.group(1)
-                        # 用反引号包裹引用来源列表
-                        wrapped_citation = f"```\n{citation_list}\n```"
-                        # 添加包裹后的引用来源列表到新内容
-                        new_content += wrapped_citation
-                        
-                        # 更新上一个结束位置
-                        last_end = end
-                    
-                    # 处理最后一个引用来源列表后的文本（如果有）
-                    if last_end < len(content):
-                        after_text = content[last_end:]
-                        # 使用正则表达式移除索引标签
-                        after_text = re.sub(r'<sup>\[\d+\]</sup>', '', after_text)
-                        after_text = re.sub(r'\[\d+\]', '', after_text)
-                        new_content += after_text
-                    
-                    # 更新消息内容
-                    message["content"] = new_content
-                else:
-                    # 如果没有找到引用来源列表，只移除索引标签
-                    content = re.sub(r'<sup>\[\d+\]</sup>', '', content)
-                    content = re.sub(r'\[\d+\]', '', content)
-                    message["content"] = content
+                # 处理结果是不动点，历史中已处理过的消息直接跳过
+                if content in self.processed:
+                    self.processed.move_to_end(content)
+                    continue
+                content = CITATION_PATTERN.sub(self._replace_token, content)
+                message["content"] = content
+                self.processed[content] = None
+                while len(self.processed) > 1024:
+                    self.processed.popitem(last=False)
         
-        return body
\ No newline at end of file
+        return body
+
+    @staticmethod
+    def _replace_token(match: re.Match) -> str:
+        """引用来源列表用反引号包裹，索引标签直接移除"""
+        citation_list = match.group(1)
+        if citation_list is None:
+            return ""
+        return f"```\n{citation_list}\n```"
+
+
+def benchmark_outlet(turns: int = 100):
+    """python citation_formatter_filter.py：多轮对话中测量outlet每轮耗时，
+    历史每轮都从JSON重新解析，与Open WebUI重发历史的方式一致"""
+    answer = (
+        "根据搜索结果[1]，这是回答的正文[2]<sup>[3]</sup>。\n" * 20
+        + "<details>\n<summary>引用来源</summary>\n"
+        + "".join(f"[{i}] https://example.com/{i}\n" for i in range(1, 11))
+        + "</details>"
+    )
+    for name, f in (("cached", Filter()), ("uncached", None)):
+        history, times = [], {}
+        for turn in range(1, turns + 1):
+            history.append({"role": "user", "content": f"问题{turn}"})
+            history.append({"role": "assistant", "content": f"第{turn}轮：" + answer})
+            body = {"messages": json.loads(json.dumps(history))}
+            start = time.perf_counter()
+            (f or Filter()).outlet(body)
+            times[turn] = time.perf_counter() - start
+            history = body["messages"]
+        print(
+            f"{name}: "
+            + ", ".join(
+                f"turn {turn} {times[turn] * 1e3:.2f}ms"
+                for turn in (1, turns // 10, turns // 2, turns)
+            )
+        )
+
+
+if __name__ == "__main__":
+    benchmark_outlet()
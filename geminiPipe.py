@@ -2,17 +2,438 @@
 title: Gemini Pipe
 author_url:https://linux.do/u/coker/summary
 author:coker
-version: 0.0.6
+version: 0.0.7
 license: MIT
 """
 
+import asyncio
+import hashlib
+import heapq
+import itertools
 import json
+import logging
 import random
+import socket
+import sqlite3
+import threading
+import time
+import unittest
+import uuid
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import httpx
+import numpy as np
 import requests
-from typing import List, AsyncGenerator, Callable, Awaitable
+from typing import List, AsyncGenerator, Callable, Awaitable, Dict, Optional, Union
 from pydantic import BaseModel, Field
 
+log = logging.getLogger(__name__)
+
+# Lower value is admitted first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+
+class AdmissionController:
+    """Limits in-flight upstream requests globally and per API key.
+    Requests that cannot start immediately wait in a priority queue and are
+    shed once their queue deadline passes."""
+
+    def __init__(self):
+        self.global_limit = 0
+        self.key_limit = 0
+        self.in_flight = 0
+        self.key_in_flight: Dict[str, int] = {}
+        self.waiters = []
+        self.counter = itertools.count()
+        self.stats = {"admitted": 0, "shed": 0, "wait_total": 0.0, "wait_max": 0.0}
+
+    def pick_key(self, keys: List[str]) -> Optional[str]:
+        if self.global_limit and self.in_flight >= self.global_limit:
+            return None
+        candidates = [
+            key
+            for key in keys
+            if not self.key_limit or self.key_in_flight.get(key, 0) < self.key_limit
+        ]
+        if not candidates:
+            return None
+        least = min(self.key_in_flight.get(key, 0) for key in candidates)
+        return random.choice(
+            [key for key in candidates if self.key_in_flight.get(key, 0) == least]
+        )
+
+    def take(self, key: str):
+        self.in_flight += 1
+        self.key_in_flight[key] = self.key_in_flight.get(key, 0) + 1
+
+    def release(self, key: str):
+        self.in_flight -= 1
+        self.key_in_flight[key] -= 1
+        self.dispatch()
+
+    def dispatch(self):
+        """Hand freed capacity to the highest-priority waiters."""
+        while self.waiters:
+            _, _, future, keys = self.waiters[0]
+            if future.done():
+                heapq.heappop(self.waiters)
+                continue
+            key = self.pick_key(keys)
+            if key is None:
+                return
+            heapq.heappop(self.waiters)
+            self.take(key)
+            future.set_result(key)
+
+    def abandon(self, future: asyncio.Future):
+        """Withdraws a queued waiter, handing back a key dispatched to it meanwhile."""
+        if future.done() and not future.cancelled():
+            self.release(future.result())
+        else:
+            future.cancel()
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(1 for waiter in self.waiters if not waiter[2].done())
+
+    def snapshot(self) -> dict:
+        admitted = self.stats["admitted"]
+        return {
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "admitted": admitted,
+            "shed": self.stats["shed"],
+            "avg_wait": self.stats["wait_total"] / admitted if admitted else 0.0,
+            "max_wait": self.stats["wait_max"],
+        }
+
+    async def acquire(
+        self, keys: List[str], priority: int, timeout: float
+    ) -> Optional[str]:
+        """Returns the API key to use, or None if the request was shed."""
+        start = time.monotonic()
+        key = None
+        # Only bypass the queue when nobody of equal or higher priority is waiting
+        if not any(
+            w[0] <= priority and not w[2].done() for w in self.waiters
+        ):
+            key = self.pick_key(keys)
+        if key is not None:
+            self.take(key)
+        else:
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self.waiters, (priority, next(self.counter), future, keys))
+            try:
+                done, _ = await asyncio.wait({future}, timeout=timeout or None)
+            except asyncio.CancelledError:
+                # The caller went away while queued (stop button, closed tab)
+                self.abandon(future)
+                raise
+            if not done:
+                self.abandon(future)
+                self.stats["shed"] += 1
+                log.warning(
+                    "Shed request (priority %d) after %.1fs in queue: %s",
+                    priority,
+                    time.monotonic() - start,
+                    self.snapshot(),
+                )
+                return None
+            key = future.result()
+
+        waited = time.monotonic() - start
+        self.stats["admitted"] += 1
+        self.stats["wait_total"] += waited
+        self.stats["wait_max"] = max(self.stats["wait_max"], waited)
+        if waited > 0.1:
+            log.info("Admitted request (priority %d) after %.2fs: %s", priority, waited, self.snapshot())
+        return key
+
+
+# JSON Schema keywords the Gemini function declaration schema rejects
+UNSUPPORTED_SCHEMA_KEYS = {"$schema", "additionalProperties", "$defs", "definitions"}
+
+
+def clean_schema(schema):
+    """Strips JSON Schema keywords that Gemini rejects from a tool parameter schema."""
+    if isinstance(schema, dict):
+        return {
+            key: clean_schema(value)
+            for key, value in schema.items()
+            if key not in UNSUPPORTED_SCHEMA_KEYS
+        }
+    if isinstance(schema, list):
+        return [clean_schema(item) for item in schema]
+    return schema
+
+
+def convert_tools(tools: list) -> list:
+    """OpenAI `tools` to Gemini `functionDeclarations`."""
+    declarations = []
+    for tool in tools or []:
+        if tool.get("type", "function") != "function" or "function" not in tool:
+            continue
+        function = tool["function"]
+        declaration = {"name": function["name"]}
+        if function.get("description"):
+            declaration["description"] = function["description"]
+        parameters = function.get("parameters")
+        # Gemini rejects an object schema without properties
+        if parameters and parameters.get("properties"):
+            declaration["parameters"] = clean_schema(parameters)
+        declarations.append(declaration)
+    return [{"functionDeclarations": declarations}] if declarations else []
+
+
+def convert_tool_choice(tool_choice) -> Optional[dict]:
+    """OpenAI `tool_choice` to Gemini `toolConfig`."""
+    if tool_choice in (None, "auto"):
+        return None
+    if tool_choice == "none":
+        config = {"mode": "NONE"}
+    elif tool_choice == "required":
+        config = {"mode": "ANY"}
+    elif isinstance(tool_choice, dict) and "function" in tool_choice:
+        config = {
+            "mode": "ANY",
+            "allowedFunctionNames": [tool_choice["function"]["name"]],
+        }
+    else:
+        return None
+    return {"functionCallingConfig": config}
+
+
+def parse_arguments(arguments) -> dict:
+    if isinstance(arguments, dict):
+        return arguments
+    try:
+        parsed = json.loads(arguments or "{}")
+    except ValueError:
+        return {"arguments": arguments}
+    return parsed if isinstance(parsed, dict) else {"value": parsed}
+
+
+def tool_call_chunk(model: str, delta: dict, finish_reason: Optional[str] = None) -> dict:
+    """A chat.completion.chunk in OpenAI format, which Open WebUI passes through."""
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+# batchEmbedContents accepts at most this many requests per call
+MAX_EMBED_BATCH = 100
+
+
+# Statuses that mean the endpoint (not the request) is unhealthy. 429 is left
+# out: Gemini returns it when the API key's quota is exhausted, and every relay
+# would answer the same for that key
+FAILOVER_STATUSES = {500, 502, 503, 504}
+
+
+class EndpointRouter:
+    """Ranks upstream endpoints by EWMA latency and error rate, and takes
+    endpoints out of rotation with a circuit breaker that probes them back in
+    after a cooldown."""
+
+    ALPHA = 0.3
+
+    def __init__(self):
+        self.endpoints: Dict[str, dict] = {}
+        self.failure_threshold = 3
+        self.cooldown = 30.0
+
+    def sync(self, urls: List[str]):
+        for url in urls:
+            self.endpoints.setdefault(
+                url,
+                {
+                    "latency": 0.0,
+                    "error_rate": 0.0,
+                    "failures": 0,
+                    "open_until": 0.0,
+                    "probing": False,
+                },
+            )
+        for url in list(self.endpoints):
+            if url not in urls:
+                del self.endpoints[url]
+
+    def candidates(self) -> List[str]:
+        """Endpoints in the order they should be tried."""
+        now = time.monotonic()
+        closed, probes, opened = [], [], []
+        for url, state in self.endpoints.items():
+            if not state["open_until"]:
+                closed.append(url)
+            elif state["open_until"] <= now and not state["probing"]:
+                probes.append(url)
+            else:
+                opened.append(url)
+        # Unmeasured endpoints score lowest so they get explored; the constant
+        # keeps the error penalty effective before any latency is recorded
+        closed.sort(
+            key=lambda url: (self.endpoints[url]["latency"] + 0.1)
+            * (1 + 10 * self.endpoints[url]["error_rate"])
+        )
+        opened.sort(key=lambda url: self.endpoints[url]["open_until"])
+        # A recovered endpoint takes one real request as its probe; failover
+        # covers the request if the probe fails before the first byte
+        return probes[:1] + closed + probes[1:] + opened
+
+    def begin(self, url: str):
+        state = self.endpoints[url]
+        if state["open_until"] and state["open_until"] <= time.monotonic():
+            state["probing"] = True
+
+    def record_success(self, url: str, latency: float):
+        state = self.endpoints.get(url)
+        if state is None:
+            return
+        state["latency"] = (
+            latency
+            if not state["latency"]
+            else self.ALPHA * latency + (1 - self.ALPHA) * state["latency"]
+        )
+        state["error_rate"] *= 1 - self.ALPHA
+        if state["open_until"]:
+            log.info("Endpoint %s recovered, closing circuit", url)
+        state.update(failures=0, open_until=0.0, probing=False)
+
+    def record_failure(self, url: str):
+        state = self.endpoints.get(url)
+        if state is None:
+            return
+        state["error_rate"] = self.ALPHA + (1 - self.ALPHA) * state["error_rate"]
+        state["failures"] += 1
+        if state["probing"] or state["failures"] >= self.failure_threshold:
+            state.update(open_until=time.monotonic() + self.cooldown, probing=False)
+            log.warning(
+                "Endpoint %s opened circuit for %.0fs after %d failures",
+                url,
+                self.cooldown,
+                state["failures"],
+            )
+
+    def best(self) -> str:
+        return self.candidates()[0]
+
+
+class UsageLedger:
+    """Aggregates token usage per user, model and API key in memory and flushes
+    the deltas to SQLite in batches from a worker thread. Counters are only
+    touched from the event loop, so they need no locking."""
+
+    def __init__(self):
+        self.totals: Dict[tuple, List[int]] = {}
+        self.pending: Dict[tuple, List[int]] = {}
+        self.windows: Dict[str, deque] = {}
+        self.window_sums: Dict[str, int] = {}
+        self.db_path = ""
+        self.flush_interval = 30.0
+        # Rate window in seconds, 0 while no limit is configured
+        self.window = 0.0
+        self.last_flush = time.monotonic()
+        self.flush_task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def key_label(api_key: str) -> str:
+        # Never persist the key itself
+        return f"...{api_key[-4:]}" if api_key else ""
+
+    def record(
+        self,
+        user_id: str,
+        model: str,
+        api_key: str,
+        usage: dict,
+        cancelled: bool = False,
+    ):
+        prompt = usage.get("promptTokenCount", 0)
+        output = usage.get("candidatesTokenCount", 0) + usage.get("thoughtsTokenCount", 0)
+        total = usage.get("totalTokenCount") or prompt + output
+        row = (user_id, model, self.key_label(api_key))
+        delta = (1, prompt, output, total, int(cancelled))
+        for table in (self.totals, self.pending):
+            counters = table.setdefault(row, [0, 0, 0, 0, 0])
+            for index, value in enumerate(delta):
+                counters[index] += value
+        if self.window:
+            self.windows.setdefault(user_id, deque()).append((time.monotonic(), total))
+            self.window_sums[user_id] = self.window_sums.get(user_id, 0) + total
+            self.window_usage(user_id)
+        if (
+            self.db_path
+            and time.monotonic() - self.last_flush >= self.flush_interval
+            and (self.flush_task is None or self.flush_task.done())
+        ):
+            self.flush_task = asyncio.create_task(self.flush())
+
+    def window_usage(self, user_id: str) -> int:
+        """Tokens the user spent within the current window."""
+        entries = self.windows.get(user_id)
+        if not entries:
+            return 0
+        cutoff = time.monotonic() - self.window
+        while entries and entries[0][0] < cutoff:
+            self.window_sums[user_id] -= entries.popleft()[1]
+        return self.window_sums[user_id]
+
+    def retry_after(self, user_id: str) -> float:
+        entries = self.windows.get(user_id)
+        if not entries:
+            return 0.0
+        return max(0.0, entries[0][0] + self.window - time.monotonic())
+
+    async def flush(self):
+        self.last_flush = time.monotonic()
+        if not self.pending or not self.db_path:
+            return
+        rows, self.pending = self.pending, {}
+        day = time.strftime("%Y-%m-%d")
+        try:
+            await asyncio.to_thread(self._write_rows, self.db_path, day, rows)
+        except Exception as e:
+            log.warning("Flushing %d usage rows failed: %s", len(rows), e)
+            # Merge back so the deltas go out with the next flush
+            for row, counters in rows.items():
+                merged = self.pending.setdefault(row, [0, 0, 0, 0, 0])
+                for index, value in enumerate(counters):
+                    merged[index] += value
+
+    @staticmethod
+    def _write_rows(db_path: str, day: str, rows: Dict[tuple, List[int]]):
+        with sqlite3.connect(db_path) as conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS gemini_usage (
+                    day TEXT, user_id TEXT, model TEXT, api_key TEXT,
+                    requests INTEGER, prompt_tokens INTEGER, output_tokens INTEGER,
+                    total_tokens INTEGER, cancelled INTEGER,
+                    PRIMARY KEY (day, user_id, model, api_key))"""
+            )
+            conn.executemany(
+                """INSERT INTO gemini_usage VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (day, user_id, model, api_key) DO UPDATE SET
+                    requests = requests + excluded.requests,
+                    prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                    output_tokens = output_tokens + excluded.output_tokens,
+                    total_tokens = total_tokens + excluded.total_tokens,
+                    cancelled = cancelled + excluded.cancelled""",
+                [(day, *row, *counters) for row, counters in rows.items()],
+            )
+        conn.close()
+
+    def snapshot(self) -> List[dict]:
+        fields = ("requests", "prompt_tokens", "output_tokens", "total_tokens", "cancelled")
+        return [
+            {"user_id": user_id, "model": model, "api_key": key, **dict(zip(fields, counters))}
+            for (user_id, model, key), counters in self.totals.items()
+        ]
+
 
 class Pipe:
     class Valves(BaseModel):
@@ -22,7 +443,14 @@ class Pipe:
         OPEN_SAFETY: bool = Field(default=False, description="Gemini safety settings")
         BASE_URL: str = Field(
             default="https://generativelanguage.googleapis.com/v1beta",
-            description="API Base Url",
+            description="API Base Url, use , to split multiple endpoints for failover",
+        )
+        CIRCUIT_FAILURE_THRESHOLD: int = Field(
+            default=3,
+            description="Consecutive failures before an endpoint is taken out of rotation",
+        )
+        CIRCUIT_COOLDOWN: float = Field(
+            default=30, description="Seconds before an unhealthy endpoint is probed again"
         )
         OPEN_SEARCH_INFO: bool = Field(
             default=True, description="Open search info show "
@@ -30,6 +458,59 @@ class Pipe:
         FILTER_THINKING_TAGS: bool = Field(
             default=True, description="Filter <thinking> tags in thinking content"
         )
+        MAX_CONCURRENT_REQUESTS: int = Field(
+            default=0, description="Max in-flight upstream requests, 0 for unlimited"
+        )
+        MAX_CONCURRENT_PER_KEY: int = Field(
+            default=0, description="Max in-flight upstream requests per API key, 0 for unlimited"
+        )
+        INTERACTIVE_QUEUE_TIMEOUT: float = Field(
+            default=60, description="Seconds a chat request may wait for a slot"
+        )
+        BACKGROUND_QUEUE_TIMEOUT: float = Field(
+            default=10,
+            description="Seconds a background task (title, tags, follow-ups) may wait before it is dropped",
+        )
+        TASK_MODEL_ROUTES: str = Field(
+            default="",
+            description="Route request classes to fast models, e.g. title_generation=gemini-2.0-flash-lite,small_prompt=gemini-2.0-flash,*=gemini-2.0-flash-lite ('*' matches any background task)",
+        )
+        ROUTED_MAX_OUTPUT_TOKENS: int = Field(
+            default=512, description="maxOutputTokens for routed requests"
+        )
+        REQUEST_TIMEOUT: float = Field(
+            default=120, description="Upstream read timeout in seconds"
+        )
+        SMALL_PROMPT_CHARS: int = Field(
+            default=0,
+            description="Chat requests shorter than this many characters are classed as small_prompt, 0 to disable",
+        )
+        USER_TOKEN_LIMIT: int = Field(
+            default=0,
+            description="Max tokens a user may spend per USER_TOKEN_WINDOW, 0 for unlimited",
+        )
+        USER_TOKEN_WINDOW: float = Field(
+            default=60, description="Sliding window in seconds for USER_TOKEN_LIMIT"
+        )
+        USAGE_DB_PATH: str = Field(
+            default="",
+            description="SQLite file that per-user/model/key token usage is flushed to, empty to keep it in memory only",
+        )
+        USAGE_FLUSH_INTERVAL: float = Field(
+            default=30, description="Seconds between usage flushes to USAGE_DB_PATH"
+        )
+        EMBEDDING_MODEL: str = Field(
+            default="gemini-embedding-001",
+            description="Model used by Pipe.embed() for document embeddings",
+        )
+        EMBEDDING_BATCH_SIZE: int = Field(
+            default=MAX_EMBED_BATCH,
+            description=f"Texts per batchEmbedContents call, at most {MAX_EMBED_BATCH}",
+        )
+        EMBEDDING_CACHE_SIZE: int = Field(
+            default=10000,
+            description="Embeddings kept by content hash to skip unchanged chunks, 0 to disable",
+        )
 
     def __init__(self):
         self.type = "manifold"
@@ -39,21 +520,349 @@ class Pipe:
         self.OPEN_THINK_MODELS = []
 
         self.base_url = ""
-        self.emitter = None
-        self.open_search = False
-        self.open_think = False
-        self.think_first = True
+        self.admission = AdmissionController()
+        self.router = EndpointRouter()
+        self.client: Optional[httpx.AsyncClient] = None
+        self.cancel_stats = {"cancelled": 0, "partial_tokens": 0}
+        # Gemini thought signatures by tool call id; they must be sent back with
+        # the function call on the next turn or thinking models reject it
+        self.thought_signatures: OrderedDict = OrderedDict()
+        self.embedding_cache: OrderedDict = OrderedDict()
+        self.usage = UsageLedger()
+        self.routing_stats = {
+            "routed": {},
+            "routed_latency": [0.0, 0],
+            "default_latency": [0.0, 0],
+            # Tokens routed requests actually used, by request class: [input, output]
+            "routed_tokens": {},
+        }
+
+    @staticmethod
+    def get_task(body: dict, __metadata__: Optional[dict], __task__: Optional[str]) -> Optional[str]:
+        """Returns the Open WebUI background task name, or None for chat requests."""
+        return __task__ or (__metadata__ or {}).get("task") or body.get("task")
+
+    def sync_endpoints(self) -> List[str]:
+        urls = [
+            url.strip().rstrip("/") for url in self.valves.BASE_URL.split(",") if url.strip()
+        ]
+        self.router.sync(urls)
+        self.router.failure_threshold = self.valves.CIRCUIT_FAILURE_THRESHOLD
+        self.router.cooldown = self.valves.CIRCUIT_COOLDOWN
+        return urls
+
+    async def send_upstream(
+        self,
+        path: str,
+        request_data: dict,
+        params: dict,
+        stream: bool,
+    ) -> httpx.Response:
+        """Sends the request to the best endpoint, failing over to the next one on
+        connection errors or endpoint-level error statuses. Streaming responses are
+        returned once headers arrive, so failover happens before the first byte."""
+        client = self.get_client()
+        candidates = self.router.candidates()
+        last_error = None
+        for index, base_url in enumerate(candidates):
+            self.router.begin(base_url)
+            started = time.monotonic()
+            request = client.build_request(
+                "POST",
+                f"{base_url}{path}",
+                json=request_data,
+                headers={"Content-Type": "application/json"},
+                params=params,
+            )
+            try:
+                response = await client.send(request, stream=stream)
+            except httpx.TransportError as e:
+                self.router.record_failure(base_url)
+                last_error = e
+                log.warning("Endpoint %s failed: %r", base_url, e)
+                continue
+            if response.status_code in FAILOVER_STATUSES:
+                self.router.record_failure(base_url)
+                if index < len(candidates) - 1:
+                    log.warning(
+                        "Endpoint %s returned HTTP %d, failing over",
+                        base_url,
+                        response.status_code,
+                    )
+                    await response.aclose()
+                    continue
+            else:
+                self.router.record_success(base_url, time.monotonic() - started)
+            return response
+        raise last_error or Exception("No upstream endpoint available")
+
+    def get_client(self) -> httpx.AsyncClient:
+        """Shared pooled HTTP client for upstream requests."""
+        if self.client is None or self.client.is_closed:
+            self.client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.valves.REQUEST_TIMEOUT, connect=10),
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+            )
+        return self.client
+
+    def record_cancelled(
+        self,
+        model_id: str,
+        usage: dict,
+        streamed_chars: int,
+        user_id: str = "",
+        api_key: str = "",
+    ):
+        """Records a stream abandoned by the client, with the tokens generated so far."""
+        # Fall back to a rough chars-per-token estimate when no usage was streamed yet
+        tokens = usage.get("candidatesTokenCount") or streamed_chars // 4
+        self.cancel_stats["cancelled"] += 1
+        self.cancel_stats["partial_tokens"] += tokens
+        # Partial output was still generated and billed, so it counts against quotas
+        self.usage.record(
+            user_id,
+            model_id,
+            api_key,
+            {**usage, "candidatesTokenCount": tokens, "totalTokenCount": 0},
+            cancelled=True,
+        )
+        log.info(
+            "Client closed %s stream after %d chars (~%d output tokens), upstream aborted",
+            model_id,
+            streamed_chars,
+            tokens,
+        )
+
+    def check_quota(self, user_id: str, messages: List[dict]) -> Optional[str]:
+        """Returns an error message if the request would exceed the user's token rate."""
+        self.usage.db_path = self.valves.USAGE_DB_PATH
+        self.usage.flush_interval = self.valves.USAGE_FLUSH_INTERVAL
+        limit = self.valves.USER_TOKEN_LIMIT
+        window = self.valves.USER_TOKEN_WINDOW
+        self.usage.window = window if limit else 0.0
+        if not limit:
+            return None
+        used = self.usage.window_usage(user_id)
+        # Count the prompt up front (about 4 chars per token) so one huge request
+        # cannot overshoot the limit by much
+        prompt_tokens = sum(len(str(message.get("content") or "")) for message in messages) // 4
+        if used and used + prompt_tokens > limit:
+            retry = self.usage.retry_after(user_id)
+            log.info(
+                "User %s over token limit (%d used + ~%d > %d)",
+                user_id,
+                used,
+                prompt_tokens,
+                limit,
+            )
+            return f"Error: Token limit reached ({used}/{limit} in {window:.0f}s), retry in {retry:.0f}s"
+        return None
+
+    def classify_request(self, task: Optional[str], messages: List[dict]) -> Optional[str]:
+        """Returns the routing class of a request: the task name, small_prompt or None."""
+        if task:
+            return task
+        if self.valves.SMALL_PROMPT_CHARS:
+            size = sum(
+                len(message["content"])
+                for message in messages
+                if isinstance(message.get("content"), str)
+            )
+            if size < self.valves.SMALL_PROMPT_CHARS:
+                return "small_prompt"
+        return None
+
+    def route_model(self, request_class: Optional[str]) -> Optional[str]:
+        """Looks up the fast model for a request class in TASK_MODEL_ROUTES."""
+        if not request_class:
+            return None
+        routes = {}
+        for entry in self.valves.TASK_MODEL_ROUTES.split(","):
+            name, _, model = entry.partition("=")
+            if name.strip() and model.strip():
+                routes[name.strip()] = model.strip()
+        if request_class in routes:
+            return routes[request_class]
+        if request_class != "small_prompt":
+            return routes.get("*")
+        return None
+
+    def record_latency(self, routed: bool, elapsed: float):
+        total = self.routing_stats["routed_latency" if routed else "default_latency"]
+        total[0] += elapsed
+        total[1] += 1
+
+    def record_routed_usage(self, request_class: Optional[str], usage: dict):
+        """Adds the tokens a routed request actually used to its class's counters."""
+        if not request_class or not usage:
+            return
+        tokens = self.routing_stats["routed_tokens"].setdefault(request_class, [0, 0])
+        tokens[0] += usage.get("promptTokenCount", 0)
+        tokens[1] += usage.get("candidatesTokenCount", 0) + usage.get("thoughtsTokenCount", 0)
+
+    def routing_snapshot(self) -> dict:
+        """Routing counters, with latency saved estimated against unrouted requests."""
+        routed_total, routed_count = self.routing_stats["routed_latency"]
+        default_total, default_count = self.routing_stats["default_latency"]
+        routed_avg = routed_total / routed_count if routed_count else 0.0
+        default_avg = default_total / default_count if default_count else 0.0
+        return {
+            "routed": dict(self.routing_stats["routed"]),
+            "avg_latency_routed": routed_avg,
+            "avg_latency_default": default_avg,
+            "est_latency_saved": (
+                (default_avg - routed_avg) * routed_count if default_count else 0.0
+            ),
+            "routed_tokens": {
+                request_class: {"input": tokens[0], "output": tokens[1]}
+                for request_class, tokens in self.routing_stats["routed_tokens"].items()
+            },
+        }
+
+    async def embed_batch(
+        self, model: str, texts: List[str], task_type: Optional[str]
+    ) -> np.ndarray:
+        """Embeds one batch with a key from the pool. Batches wait behind chat
+        requests in the admission queue, since ingestion is throughput-bound."""
+        api_key = await self.admission.acquire(
+            self.GOOGLE_API_KEYS_LIST, PRIORITY_BACKGROUND, 0
+        )
+        try:
+            requests_data = []
+            for text in texts:
+                request = {"model": f"models/{model}", "content": {"parts": [{"text": text}]}}
+                if task_type:
+                    request["taskType"] = task_type
+                requests_data.append(request)
+            response = await self.send_upstream(
+                f"/models/{model}:batchEmbedContents",
+                {"requests": requests_data},
+                {"key": api_key},
+                stream=False,
+            )
+            if response.status_code != 200:
+                raise Exception(f"HTTP {response.status_code}: {response.text}")
+            return np.array(
+                [item["values"] for item in response.json()["embeddings"]],
+                dtype=np.float32,
+            )
+        finally:
+            self.admission.release(api_key)
+
+    async def embed(
+        self,
+        texts: List[str],
+        model: Optional[str] = None,
+        task_type: Optional[str] = None,
+    ) -> np.ndarray:
+        """Embeds texts into a float32 matrix with one row per text. Unique texts
+        that miss the cache are split into maximal batches sent concurrently.
+
+        This is the supported embedding API: Open WebUI only routes chat bodies
+        to pipes, so ingestion code calls it directly, e.g.
+        `vectors = await pipe.embed(chunks, task_type="RETRIEVAL_DOCUMENT")`."""
+        # Callable directly by ingestion code, so apply the valves here too
+        self.GOOGLE_API_KEYS_LIST = [
+            key.strip() for key in self.valves.GOOGLE_API_KEYS_STR.split(",") if key.strip()
+        ]
+        if not self.GOOGLE_API_KEYS_LIST or not self.sync_endpoints():
+            raise Exception("GOOGLE_API_KEY or BASE_URL is not set")
+        self.admission.global_limit = self.valves.MAX_CONCURRENT_REQUESTS
+        self.admission.key_limit = self.valves.MAX_CONCURRENT_PER_KEY
+        model = model or self.valves.EMBEDDING_MODEL
+        cache_size = self.valves.EMBEDDING_CACHE_SIZE
+        digests = [
+            hashlib.sha256(f"{model}\0{task_type}\0{text}".encode()).digest()
+            for text in texts
+        ]
+        vectors = {}
+        pending = {}
+        for digest, text in zip(digests, texts):
+            if digest in vectors or digest in pending:
+                continue
+            cached = self.embedding_cache.get(digest)
+            if cached is not None:
+                self.embedding_cache.move_to_end(digest)
+                vectors[digest] = cached
+            else:
+                pending[digest] = text
+
+        if pending:
+            size = max(1, min(self.valves.EMBEDDING_BATCH_SIZE, MAX_EMBED_BATCH))
+            keys = list(pending)
+            batches = [keys[i : i + size] for i in range(0, len(keys), size)]
+            results = await asyncio.gather(
+                *(
+                    self.embed_batch(model, [pending[key] for key in batch], task_type)
+                    for batch in batches
+                ),
+                return_exceptions=True,
+            )
+            error = None
+            for batch, matrix in zip(batches, results):
+                if isinstance(matrix, BaseException):
+                    error = error or matrix
+                    continue
+                for key, row in zip(batch, matrix):
+                    vectors[key] = row
+                    if cache_size:
+                        self.embedding_cache[key] = row
+            while len(self.embedding_cache) > cache_size:
+                self.embedding_cache.popitem(last=False)
+            # Batches that succeeded stay cached, so a retry only resends the rest
+            if error:
+                raise error
+            log.info(
+                "Embedded %d texts (%d cached) in %d batches",
+                len(texts),
+                len(texts) - len(pending),
+                len(batches),
+            )
+
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.stack([vectors[digest] for digest in digests])
+
+    def fetch_models(self) -> requests.Response:
+        """Lists models from the best endpoint, failing over like send_upstream."""
+        candidates = self.router.candidates()
+        last_error = None
+        for index, base_url in enumerate(candidates):
+            self.router.begin(base_url)
+            started = time.monotonic()
+            try:
+                response = requests.get(
+                    f"{base_url}/models", params={"key": self.GOOGLE_API_KEY}, timeout=10
+                )
+            except requests.RequestException as e:
+                self.router.record_failure(base_url)
+                last_error = e
+                log.warning("Endpoint %s failed: %r", base_url, e)
+                continue
+            if response.status_code in FAILOVER_STATUSES:
+                self.router.record_failure(base_url)
+                if index < len(candidates) - 1:
+                    log.warning(
+                        "Endpoint %s returned HTTP %d, failing over",
+                        base_url,
+                        response.status_code,
+                    )
+                    continue
+            else:
+                self.router.record_success(base_url, time.monotonic() - started)
+            self.base_url = base_url
+            return response
+        raise last_error or Exception("BASE_URL is not set")
 
     def get_google_models(self) -> List[dict]:
-        self.base_url = self.valves.BASE_URL
         self.GOOGLE_API_KEYS_LIST = self.valves.GOOGLE_API_KEYS_STR.split(",")
         self.GOOGLE_API_KEY = random.choice(self.GOOGLE_API_KEYS_LIST)
         if not self.GOOGLE_API_KEY:
             return [{"id": "error", "name": f"Error: API Key not found"}]
 
         try:
-            url = f"{self.base_url}/models?key={self.GOOGLE_API_KEY}"
-            response = requests.get(url, timeout=10)
+            self.sync_endpoints()
+            response = self.fetch_models()
 
             if response.status_code != 200:
                 raise Exception(f"HTTP {response.status_code}: {response.text}")
@@ -81,13 +890,15 @@ class Pipe:
         except Exception as e:
             return [{"id": "error", "name": f"Could not fetch models: {str(e)}"}]
 
+    @staticmethod
     async def emit_status(
-        self,
+        emitter: Optional[Callable[[dict], Awaitable[None]]],
         message: str = "",
         done: bool = False,
     ):
-        if self.emitter:
-            await self.emitter(
+        """Sends a status event to the emitter of the request it belongs to."""
+        if emitter:
+            await emitter(
                 {
                     "type": "status",
                     "data": {
@@ -114,12 +925,48 @@ class Pipe:
 
         return think_info
 
-    async def do_parts(self, parts):
+    def convert_tool_calls(self, message: dict) -> List[dict]:
+        """Assistant `tool_calls` to Gemini `functionCall` parts."""
+        parts = []
+        for tool_call in message.get("tool_calls") or []:
+            function = tool_call.get("function", {})
+            part = {
+                "functionCall": {
+                    "name": function.get("name"),
+                    "args": parse_arguments(function.get("arguments")),
+                }
+            }
+            signature = self.thought_signatures.get(tool_call.get("id"))
+            if signature:
+                part["thoughtSignature"] = signature
+            parts.append(part)
+        return parts
+
+    def function_call_to_openai(self, part: dict, index: int) -> dict:
+        call_id = f"call_{uuid.uuid4().hex[:24]}"
+        if part.get("thoughtSignature"):
+            self.thought_signatures[call_id] = part["thoughtSignature"]
+            while len(self.thought_signatures) > 1024:
+                self.thought_signatures.popitem(last=False)
+        call = part["functionCall"]
+        return {
+            "index": index,
+            "id": call_id,
+            "type": "function",
+            "function": {
+                "name": call.get("name"),
+                "arguments": json.dumps(call.get("args") or {}, ensure_ascii=False),
+            },
+        }
+
+    async def do_parts(self, parts, state: dict):
+        """`state` holds the per-request search/think flags and event emitter,
+        so concurrent requests never see each other's mode or status."""
         if not parts or not isinstance(parts, list):
             return "Error: No parts found"
         if len(parts) == 1:
-            if self.open_think and self.think_first:
-                self.think_first = False
+            if state["think"] and state["think_first"]:
+                state["think_first"] = False
                 # Process thinking content
                 processed_thinking = self.create_think_info(parts[0]["text"])
                 return (
@@ -128,10 +975,10 @@ class Pipe:
                 )
             return parts[0]["text"]
         if len(parts) == 2:
-            await self.emit_status(message="😄 思考已结束", done=False)
-            self.open_think = False
-            if self.think_first:
-                self.think_first = False
+            await self.emit_status(state["emitter"], message="😄 思考已结束", done=False)
+            state["think"] = False
+            if state["think_first"]:
+                state["think_first"] = False
                 # Process thinking content
                 processed_thinking = self.create_think_info(parts[0]["text"])
                 return (
@@ -152,14 +999,97 @@ class Pipe:
         self,
         body: dict,
         __event_emitter__: Callable[[dict], Awaitable[None]] = None,
-    ) -> AsyncGenerator[str, None]:
-        self.emitter = __event_emitter__
-        self.GOOGLE_API_KEYS_LIST = self.valves.GOOGLE_API_KEYS_STR.split(",")
-        self.GOOGLE_API_KEY = random.choice(self.GOOGLE_API_KEYS_LIST)
-        self.base_url = self.valves.BASE_URL
-        if not self.GOOGLE_API_KEY:
+        __metadata__: Optional[dict] = None,
+        __task__: Optional[str] = None,
+        __user__: Optional[dict] = None,
+    ) -> Union[str, dict, AsyncGenerator[Union[str, dict], None]]:
+        """Returns the response generator for streaming requests. Non-streaming
+        requests get the final text, or a chat.completion dict for tool calls,
+        since Open WebUI stringifies anything a non-streaming generator yields."""
+        response = self.respond(body, __event_emitter__, __metadata__, __task__, __user__)
+        if body.get("stream", False):
+            return response
+        texts = []
+        try:
+            async for chunk in response:
+                if isinstance(chunk, dict):
+                    return chunk
+                texts.append(chunk)
+        finally:
+            # Releases the admission slot and upstream connection right away,
+            # including when the caller is cancelled
+            await response.aclose()
+        return "".join(texts)
+
+    async def respond(
+        self,
+        body: dict,
+        __event_emitter__: Callable[[dict], Awaitable[None]] = None,
+        __metadata__: Optional[dict] = None,
+        __task__: Optional[str] = None,
+        __user__: Optional[dict] = None,
+    ) -> AsyncGenerator[Union[str, dict], None]:
+        user_id = (__user__ or {}).get("id", "")
+        self.GOOGLE_API_KEYS_LIST = [
+            key.strip() for key in self.valves.GOOGLE_API_KEYS_STR.split(",") if key.strip()
+        ]
+        if not self.sync_endpoints():
+            yield "Error: BASE_URL is not set"
+            return
+        if not self.GOOGLE_API_KEYS_LIST:
             yield "Error: GOOGLE_API_KEY is not set"
             return
+
+        quota_error = self.check_quota(user_id, body.get("messages", []))
+        if quota_error:
+            yield quota_error
+            await self.emit_status(__event_emitter__, message="❌ 用量超限", done=True)
+            return
+
+        task = self.get_task(body, __metadata__, __task__)
+        if task:
+            priority, timeout = PRIORITY_BACKGROUND, self.valves.BACKGROUND_QUEUE_TIMEOUT
+        else:
+            priority, timeout = PRIORITY_INTERACTIVE, self.valves.INTERACTIVE_QUEUE_TIMEOUT
+        self.admission.global_limit = self.valves.MAX_CONCURRENT_REQUESTS
+        self.admission.key_limit = self.valves.MAX_CONCURRENT_PER_KEY
+        if not task and self.admission.pick_key(self.GOOGLE_API_KEYS_LIST) is None:
+            await self.emit_status(
+                __event_emitter__,
+                message=f"⏳ 排队中……（前方 {self.admission.queue_depth} 个请求）"
+            )
+        api_key = await self.admission.acquire(
+            self.GOOGLE_API_KEYS_LIST, priority, timeout
+        )
+        if api_key is None:
+            # Background tasks are dropped silently so Open WebUI keeps its defaults
+            if not task:
+                yield "Error: Too many requests in queue, please try again later"
+                await self.emit_status(__event_emitter__, message="❌ 排队超时", done=True)
+            return
+        generator = self.generate(body, api_key, task, user_id, __event_emitter__)
+        try:
+            async for chunk in generator:
+                yield chunk
+        finally:
+            # Close the inner generator now rather than on garbage collection, so
+            # the upstream stream and its pooled connection are released promptly
+            await generator.aclose()
+            self.admission.release(api_key)
+
+    async def generate(
+        self,
+        body: dict,
+        api_key: str,
+        task: Optional[str] = None,
+        user_id: str = "",
+        emitter: Optional[Callable[[dict], Awaitable[None]]] = None,
+    ) -> AsyncGenerator[Union[str, dict], None]:
+        started = time.monotonic()
+        routed_model = None
+        # Response handling mode and status emitter, kept per request instead of
+        # on the shared Pipe, since requests interleave while queued or streaming
+        state = {"search": False, "think": False, "think_first": True, "emitter": emitter}
         try:
             model_id = body["model"]
             if "." in model_id:
@@ -178,60 +1108,101 @@ class Pipe:
                 },
             }
 
+            # Function names by tool call id, since OpenAI tool results only carry the id
+            call_names = {}
             for message in messages:
                 if message["role"] == "system":
                     request_data["system_instruction"] = {
                         "parts": [{"text": message["content"]}]
                     }
-                if message["role"] != "system":
-                    if isinstance(message.get("content"), str):
-                        contents.append(
-                            {
-                                "role": (
-                                    "user" if message["role"] == "user" else "model"
-                                ),
-                                "parts": [{"text": message["content"]}],
-                            }
+                    continue
+                if message["role"] == "tool":
+                    result = message.get("content")
+                    if isinstance(result, list):
+                        result = "".join(
+                            item.get("text", "") for item in result if isinstance(item, dict)
                         )
-                    if isinstance(message.get("content"), list):
-                        parts = []
-                        for content in message["content"]:
-                            if content["type"] == "text":
-                                parts.append({"text": content["text"]})
-                            elif content["type"] == "image_url":
-                                image_url = content["image_url"]["url"]
-                                if image_url.startswith("data:image"):
-                                    image_data = image_url.split(",")[1]
-                                    parts.append(
-                                        {
-                                            "inline_data": {
-                                                "mime_type": "image/jpeg",
-                                                "data": image_data,
-                                            }
+                    part = {
+                        "functionResponse": {
+                            "name": call_names.get(message.get("tool_call_id"))
+                            or message.get("name", ""),
+                            "response": {"content": result},
+                        }
+                    }
+                    # Results of parallel calls go back together in one turn
+                    if contents and "functionResponse" in contents[-1]["parts"][0]:
+                        contents[-1]["parts"].append(part)
+                    else:
+                        contents.append({"role": "user", "parts": [part]})
+                    continue
+                if isinstance(message.get("content"), str):
+                    parts = [{"text": message["content"]}] if message["content"] else []
+                elif isinstance(message.get("content"), list):
+                    parts = []
+                    for content in message["content"]:
+                        if content["type"] == "text":
+                            parts.append({"text": content["text"]})
+                        elif content["type"] == "image_url":
+                            image_url = content["image_url"]["url"]
+                            if image_url.startswith("data:image"):
+                                image_data = image_url.split(",")[1]
+                                parts.append(
+                                    {
+                                        "inline_data": {
+                                            "mime_type": "image/jpeg",
+                                            "data": image_data,
                                         }
-                                    )
-                                else:
-                                    parts.append({"image_url": image_url})
-                        contents.append(
-                            {
-                                "role": (
-                                    "user" if message["role"] == "user" else "model"
-                                ),
-                                "parts": parts,
-                            }
-                        )
+                                    }
+                                )
+                            else:
+                                parts.append({"image_url": image_url})
+                else:
+                    parts = []
+                if message.get("tool_calls"):
+                    for tool_call in message["tool_calls"]:
+                        call_names[tool_call.get("id")] = tool_call.get("function", {}).get("name")
+                    parts.extend(self.convert_tool_calls(message))
+                if parts:
+                    contents.append(
+                        {
+                            "role": "user" if message["role"] == "user" else "model",
+                            "parts": parts,
+                        }
+                    )
             request_data["contents"] = contents
-            if model_id.endswith("-search"):
+            function_tools = convert_tools(body.get("tools"))
+            if function_tools:
+                request_data["tools"] = function_tools
+                tool_config = convert_tool_choice(body.get("tool_choice"))
+                if tool_config:
+                    request_data["toolConfig"] = tool_config
+            request_class = self.classify_request(task, messages)
+            routed_model = self.route_model(request_class)
+            if routed_model:
+                # Fast path: no search tools, thinking decoration or status noise
+                requested = request_data["generationConfig"]["maxOutputTokens"]
+                capped = min(requested, self.valves.ROUTED_MAX_OUTPUT_TOKENS)
+                request_data["generationConfig"]["maxOutputTokens"] = capped
+                stats = self.routing_stats
+                stats["routed"][request_class] = stats["routed"].get(request_class, 0) + 1
+                log.info(
+                    "Routing %s request from %s to %s (maxOutputTokens %d)",
+                    request_class,
+                    model_id,
+                    routed_model,
+                    capped,
+                )
+                model_id = routed_model
+            elif model_id.endswith("-search"):
                 model_id = model_id[:-7]
-                request_data["tools"] = [{"googleSearch": {}}]
-                self.open_search = True
-                await self.emit_status(message="🔍 我好像在搜索……")
+                request_data.setdefault("tools", []).append({"googleSearch": {}})
+                state["search"] = True
+                await self.emit_status(emitter, message="🔍 我好像在搜索……")
             elif model_id in self.OPEN_THINK_MODELS:
-                await self.emit_status(message="🧐 我好像在思考……")
-                self.open_think = True
-                self.think_first = True
+                await self.emit_status(emitter, message="🧐 我好像在思考……")
+                state["think"] = True
             else:
-                await self.emit_status(message="🚀 飞速生成中……")
+                await self.emit_status(emitter, message="🚀 飞速生成中……")
             if self.valves.OPEN_SAFETY:
                 request_data["safetySettings"] = [
                     {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
@@ -248,41 +1219,66 @@ class Pipe:
                         "threshold": "BLOCK_NONE",
                     },
                 ]
-            params = {"key": self.GOOGLE_API_KEY}
+            params = {"key": api_key}
             if stream:
-                url = f"{self.base_url}/models/{model_id}:streamGenerateContent"
+                path = f"/models/{model_id}:streamGenerateContent"
                 params["alt"] = "sse"
             else:
-                url = f"{self.base_url}/models/{model_id}:generateContent"
-            headers = {"Content-Type": "application/json"}
-            async with httpx.AsyncClient() as client:
-                if stream:
-                    async with client.stream(
-                        "POST",
-                        url,
-                        json=request_data,
-                        headers=headers,
-                        params=params,
-                        timeout=120,
-                    ) as response:
+                path = f"/models/{model_id}:generateContent"
+            if stream:
+                usage = {}
+                streamed_chars = 0
+                tool_call_count = 0
+                recorded = False
+                try:
+                    response = await self.send_upstream(
+                        path, request_data, params, stream=True
+                    )
+                    try:
                         if response.status_code != 200:
+                            await response.aread()
                             yield f"Error: HTTP {response.status_code}: {response.text}"
-                            await self.emit_status(message="❌ 生成失败", done=True)
+                            await self.emit_status(emitter, message="❌ 生成失败", done=True)
                             return
 
                         async for line in response.aiter_lines():
                             if line.startswith("data: "):
                                 try:
                                     data = json.loads(line[6:])
+                                    usage = data.get("usageMetadata", usage)
                                     if "candidates" in data and data["candidates"]:
                                         parts = data["candidates"][0]["content"][
                                             "parts"
                                         ]
-                                        text = await self.do_parts(parts)
-                                        yield text
+                                        calls = [
+                                            part for part in parts if "functionCall" in part
+                                        ]
+                                        if calls:
+                                            # Parallel calls in one chunk become one delta
+                                            tool_calls = [
+                                                self.function_call_to_openai(part, index)
+                                                for index, part in enumerate(
+                                                    calls, tool_call_count
+                                                )
+                                            ]
+                                            tool_call_count += len(calls)
+                                            yield tool_call_chunk(
+                                                model_id,
+                                                {
+                                                    "role": "assistant",
+                                                    "tool_calls": tool_calls,
+                                                },
+                                            )
+                                            parts = [
+                                                part for part in parts if "text" in part
+                                            ]
+                                        if parts:
+                                            text = await self.do_parts(parts, state)
+                                            streamed_chars += len(text)
+                                            yield text
                                         try:
                                             if (
-                                                self.open_search
+                                                state["search"]
                                                 and self.valves.OPEN_SEARCH_INFO
                                                 and data["candidates"][0][
                                                     "groundingMetadata"
@@ -303,50 +1299,310 @@ class Pipe:
                                             pass
                                 except Exception as e:
                                     yield f"Error parsing stream: {str(e)}"
-                        await self.emit_status(message="🎉 生成成功", done=True)
-                else:
-                    response = await client.post(
-                        url,
-                        json=request_data,
-                        headers=headers,
-                        params=params,
-                        timeout=120,
+                        if tool_call_count:
+                            yield tool_call_chunk(model_id, {}, "tool_calls")
+                        if usage:
+                            self.usage.record(user_id, model_id, api_key, usage)
+                            self.record_routed_usage(routed_model and request_class, usage)
+                            recorded = True
+                        await self.emit_status(emitter, message="🎉 生成成功", done=True)
+                    finally:
+                        await response.aclose()
+                except (GeneratorExit, asyncio.CancelledError):
+                    # Closing the upstream response in the finally above aborts the
+                    # generation instead of letting it run to the timeout
+                    if not recorded:
+                        self.record_cancelled(
+                            model_id, usage, streamed_chars, user_id, api_key
+                        )
+                    raise
+            else:
+                response = await self.send_upstream(
+                    path, request_data, params, stream=False
+                )
+                if response.status_code != 200:
+                    yield f"Error: HTTP {response.status_code}: {response.text}"
+                    return
+                data = response.json()
+                if data.get("usageMetadata"):
+                    self.usage.record(user_id, model_id, api_key, data["usageMetadata"])
+                    self.record_routed_usage(
+                        routed_model and request_class, data["usageMetadata"]
                     )
-                    if response.status_code != 200:
-                        yield f"Error: HTTP {response.status_code}: {response.text}"
-                        return
-                    data = response.json()
-                    res = ""
-                    if "candidates" in data and data["candidates"]:
-                        parts = data["candidates"][0]["content"]["parts"]
-                        res = await self.do_parts(parts)
-                        try:
-                            if (
-                                self.open_search
-                                and self.valves.OPEN_SEARCH_INFO
-                                and data["candidates"][0]["groundingMetadata"][
-                                    "groundingChunks"
-                                ]
-                            ):
-                                res += "\n---------------------------------\n"
-                                groundingChunks = data["candidates"][0][
-                                    "groundingMetadata"
-                                ]["groundingChunks"]
-                                for idx, groundingChunk in enumerate(
-                                    groundingChunks, 1
-                                ):
-                                    if "web" in groundingChunk:
-                                        res += self.create_search_link(
-                                            idx, groundingChunk["web"]
-                                        )
-                        except Exception as e:
-                            pass
-                        await self.emit_status(message="🎉 生成成功", done=True)
-                        yield res
+                res = ""
+                if "candidates" in data and data["candidates"]:
+                    parts = data["candidates"][0]["content"]["parts"]
+                    calls = [part for part in parts if "functionCall" in part]
+                    if calls:
+                        # A complete assistant message, as the OpenAI API returns
+                        # it, since tool calls cannot be expressed as plain text
+                        text_parts = [part for part in parts if "text" in part]
+                        usage = data.get("usageMetadata", {})
+                        await self.emit_status(emitter, message="🎉 生成成功", done=True)
+                        yield {
+                            "id": f"chatcmpl-{uuid.uuid4().hex}",
+                            "object": "chat.completion",
+                            "created": int(time.time()),
+                            "model": model_id,
+                            "choices": [
+                                {
+                                    "index": 0,
+                                    "message": {
+                                        "role": "assistant",
+                                        "content": (
+                                            await self.do_parts(text_parts, state)
+                                            if text_parts
+                                            else None
+                                        ),
+                                        "tool_calls": [
+                                            self.function_call_to_openai(part, index)
+                                            for index, part in enumerate(calls)
+                                        ],
+                                    },
+                                    "finish_reason": "tool_calls",
+                                }
+                            ],
+                            "usage": {
+                                "prompt_tokens": usage.get("promptTokenCount", 0),
+                                "completion_tokens": usage.get("candidatesTokenCount", 0),
+                                "total_tokens": usage.get("totalTokenCount", 0),
+                            },
+                        }
                         return
-                    else:
-                        yield "No response data"
+                    res = await self.do_parts(parts, state)
+                    try:
+                        if (
+                            state["search"]
+                            and self.valves.OPEN_SEARCH_INFO
+                            and data["candidates"][0]["groundingMetadata"][
+                                "groundingChunks"
+                            ]
+                        ):
+                            res += "\n---------------------------------\n"
+                            groundingChunks = data["candidates"][0][
+                                "groundingMetadata"
+                            ]["groundingChunks"]
+                            for idx, groundingChunk in enumerate(groundingChunks, 1):
+                                if "web" in groundingChunk:
+                                    res += self.create_search_link(
+                                        idx, groundingChunk["web"]
+                                    )
+                    except Exception as e:
+                        pass
+                    await self.emit_status(emitter, message="🎉 生成成功", done=True)
+                    yield res
                     return
+                else:
+                    yield "No response data"
+                return
         except Exception as e:
             yield f"Error: {str(e)}"
-            await self.emit_status(message="❌ 生成失败", done=True)
+            await self.emit_status(emitter, message="❌ 生成失败", done=True)
+        finally:
+            self.record_latency(routed_model is not None, time.monotonic() - started)
+
+
+class SlowUpstreamHandler(BaseHTTPRequestHandler):
+    """Gemini stub that streams one SSE chunk every 50ms for 10 seconds."""
+
+    open_streams = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        data = json.dumps(
+            {
+                "models": [
+                    {
+                        "name": "models/gemini-2.0-flash",
+                        "supportedGenerationMethods": ["generateContent"],
+                    },
+                    {"name": "models/text-embedding", "supportedGenerationMethods": ["embedContent"]},
+                ]
+            }
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if ":streamGenerateContent" not in self.path:
+            if "slow" in self.path:
+                time.sleep(0.3)
+            data = json.dumps(
+                {
+                    "candidates": [{"content": {"parts": [{"text": "hello"}], "role": "model"}}],
+                    "usageMetadata": {
+                        "promptTokenCount": 7,
+                        "candidatesTokenCount": 1,
+                        "totalTokenCount": 8,
+                    },
+                }
+            ).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        with self.lock:
+            SlowUpstreamHandler.open_streams += 1
+        try:
+            for i in range(200):
+                chunk = {"candidates": [{"content": {"parts": [{"text": f"c{i} "}], "role": "model"}}]}
+                self.wfile.write(f"data: {json.dumps(chunk)}\r\n\r\n".encode())
+                self.wfile.flush()
+                time.sleep(0.05)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            with self.lock:
+                SlowUpstreamHandler.open_streams -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UpstreamTest(unittest.IsolatedAsyncioTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), SlowUpstreamHandler)
+        cls.base_url = f"http://127.0.0.1:{cls.server.server_address[1]}/v1beta"
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.pipe = Pipe()
+        self.pipe.valves.BASE_URL = self.base_url
+        self.pipe.valves.GOOGLE_API_KEYS_STR = "test-key"
+        self.pipe.valves.MAX_CONCURRENT_REQUESTS = 1
+
+    async def asyncTearDown(self):
+        if self.pipe.client is not None:
+            await self.pipe.client.aclose()
+
+    def body(self, stream=True):
+        return {
+            "model": "google.gemini-2.0-flash",
+            "messages": [{"role": "user", "content": "hi"}],
+            "stream": stream,
+        }
+
+    async def collect(self, stream=True):
+        return [chunk async for chunk in await self.pipe.pipe(self.body(stream))]
+
+    async def assert_released(self):
+        deadline = time.monotonic() + 1
+        while SlowUpstreamHandler.open_streams and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        self.assertEqual(0, SlowUpstreamHandler.open_streams)
+        self.assertEqual(0, self.pipe.admission.in_flight)
+
+    async def test_stream_released_on_close(self):
+        response = await self.pipe.pipe(self.body())
+        self.assertEqual("c0 ", await response.__anext__())
+        self.assertEqual(1, SlowUpstreamHandler.open_streams)
+        await response.aclose()
+        await self.assert_released()
+        self.assertEqual(1, self.pipe.cancel_stats["cancelled"])
+
+    async def test_stream_released_on_cancel(self):
+        task = asyncio.create_task(self.collect())
+        await asyncio.sleep(0.2)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        await self.assert_released()
+
+    async def test_cancel_while_queued(self):
+        holder = await self.pipe.pipe(self.body())
+        await holder.__anext__()
+        queued = asyncio.create_task(self.collect())
+        await asyncio.sleep(0.05)
+        self.assertEqual(1, self.pipe.admission.queue_depth)
+        queued.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await queued
+        self.assertEqual(0, self.pipe.admission.queue_depth)
+        self.assertEqual(1, self.pipe.admission.in_flight)
+        await holder.aclose()
+        await self.assert_released()
+        self.assertEqual("hello", await self.pipe.pipe(self.body(stream=False)))
+
+    async def test_status_goes_to_own_chat(self):
+        statuses = {"a": [], "b": []}
+
+        def emitter(name):
+            async def emit(event):
+                statuses[name].append(event["data"]["description"])
+
+            return emit
+
+        first = asyncio.create_task(
+            self.pipe.pipe(
+                {**self.body(stream=False), "model": "google.gemini-slow"}, emitter("a")
+            )
+        )
+        await asyncio.sleep(0.05)
+        second = asyncio.create_task(self.pipe.pipe(self.body(stream=False), emitter("b")))
+        self.assertEqual(["hello", "hello"], await asyncio.gather(first, second))
+        self.assertEqual(["🚀 飞速生成中……", "🎉 生成成功"], statuses["a"])
+        self.assertTrue(statuses["b"][0].startswith("⏳"))
+        self.assertEqual(["🚀 飞速生成中……", "🎉 生成成功"], statuses["b"][1:])
+
+    async def test_routed_usage_counts_real_tokens(self):
+        self.pipe.valves.TASK_MODEL_ROUTES = "title_generation=gemini-2.0-flash-lite"
+        for _ in range(2):
+            response = await self.pipe.pipe(
+                self.body(stream=False), __task__="title_generation"
+            )
+            self.assertEqual("hello", response)
+        await self.pipe.pipe(self.body(stream=False))
+        snapshot = self.pipe.routing_snapshot()
+        self.assertEqual({"title_generation": 2}, snapshot["routed"])
+        self.assertEqual(
+            {"title_generation": {"input": 14, "output": 2}}, snapshot["routed_tokens"]
+        )
+
+    def test_models_fail_over(self):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            dead_url = f"http://127.0.0.1:{sock.getsockname()[1]}/v1beta"
+        self.pipe.valves.BASE_URL = f"{dead_url},{self.base_url}"
+        models = self.pipe.pipes()
+        self.assertEqual("gemini-2.0-flash", models[0]["id"])
+        self.assertNotIn("text-embedding", [model["id"] for model in models])
+        self.assertEqual(1, self.pipe.router.endpoints[dead_url]["failures"])
+        self.assertEqual(self.base_url, self.pipe.router.best())
+
+    def test_models_without_base_url(self):
+        self.pipe.valves.BASE_URL = ""
+        self.assertEqual("error", self.pipe.pipes()[0]["id"])
+
+    async def test_cancel_after_dispatch(self):
+        # The slot is handed over, but the waiter is cancelled before it resumes
+        admission = AdmissionController()
+        admission.global_limit = 1
+        key = await admission.acquire(["a"], PRIORITY_INTERACTIVE, 5)
+        waiter = asyncio.create_task(admission.acquire(["a"], PRIORITY_INTERACTIVE, 5))
+        await asyncio.sleep(0)
+        admission.release(key)
+        waiter.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiter
+        self.assertEqual(0, admission.in_flight)
+        self.assertEqual("a", await admission.acquire(["a"], PRIORITY_INTERACTIVE, 1))
+
+
+if __name__ == "__main__":
+    print("Running tests...")
+    unittest.main()
@@ -3,23 +3,222 @@ title: 网络搜索服务
 author: OpenWebUI
 author_url: https://openwebui.com
 description: 用于获取最新信息、新闻、数据、事实、游戏资讯、小说内容、影视作品、体育赛事、科技动态、产品评测、学术研究、旅游信息和时事热点的综合网络搜索服务
-version: 1.3.0
+version: 1.6.0
 license: MIT
-requirements: requests, pydantic
+requirements: requests, aiohttp, pydantic
 """
 
 from typing import Callable, Any, List, Dict, Optional, Tuple
 from pydantic import BaseModel, Field
+import aiohttp
 import requests
 import json
 import asyncio
+import itertools
+import random
 import re
+import sys
+import threading
+import time
+import unittest
+from array import array
+from collections import OrderedDict
 from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urljoin
+
+
+class GroundingAccumulator:
+    """流式响应中逐块累积引用来源和引用片段
+
+    每个数据块里groundingSupports的索引指向该块自带的groundingChunks，
+    按URI去重后映射为全局索引，最终结构与非流式响应一致。"""
+
+    def __init__(self):
+        self.chunks: List[Dict] = []
+        self.supports: List[Dict] = []
+        self.extra: Dict = {}
+        self._chunk_index: Dict[str, int] = {}
+        self._seen_supports = set()
+
+    def add(self, metadata: Dict):
+        local_map = []
+        for chunk in metadata.get("groundingChunks", []):
+            key = chunk.get("web", {}).get("uri") or json.dumps(chunk, sort_keys=True)
+            if key not in self._chunk_index:
+                self._chunk_index[key] = len(self.chunks)
+                self.chunks.append(chunk)
+            local_map.append(self._chunk_index[key])
+
+        for support in metadata.get("groundingSupports", []):
+            indices = [
+                local_map[idx] if idx < len(local_map) else idx
+                for idx in support.get("groundingChunkIndices", [])
+            ]
+            key = (support.get("segment", {}).get("text"), tuple(indices))
+            if key in self._seen_supports:
+                continue
+            self._seen_supports.add(key)
+            self.supports.append({**support, "groundingChunkIndices": indices})
+
+        for name, value in metadata.items():
+            if name not in ("groundingChunks", "groundingSupports"):
+                self.extra[name] = value
+
+    def metadata(self) -> Dict:
+        return {
+            **self.extra,
+            "groundingChunks": self.chunks,
+            "groundingSupports": self.supports,
+        }
+
+
+# 归一化时去掉的口语化虚词，以及统一的同义写法，使常见的改写落到相同的字符组合上
+QUERY_FILLERS = re.compile(
+    r"请问|帮我|帮忙|搜索一下|查一下|搜一下|搜索|查询|一下|有什么|有哪些|什么|哪些|怎么样|的|了|吗|呢|啊|吧"
+)
+QUERY_SYNONYMS = {
+    "今天": "今日",
+    "今儿": "今日",
+    "昨天": "昨日",
+    "明天": "明日",
+    "最近": "近期",
+    "消息": "新闻",
+    "资讯": "新闻",
+}
+QUERY_SYNONYM_PATTERN = re.compile("|".join(QUERY_SYNONYMS))
+QUERY_PUNCTUATION = re.compile(r"[\s\W_]+")
+
+
+class SemanticCache:
+    """近期查询的相似度缓存
+
+    查询归一化后取字符一元组和二元组（对中文同样有效），计算MinHash签名，
+    再用LSH分桶建立索引。查找只比对同桶候选，并以精确的Jaccard相似度确认，
+    耗时不随条目数线性增长。
+    条目按写入顺序过期，超出容量时淘汰最早写入的条目。"""
+
+    NUM_PERM = 32
+    BANDS = 8
+    ROWS = NUM_PERM // BANDS
+    PRIME = (1 << 61) - 1
+
+    def __init__(self, size: int = 10000, ttl: float = 600, threshold: float = 0.8):
+        self.size = size
+        self.ttl = ttl
+        self.threshold = threshold
+        rng = random.Random(0x5EED)
+        self._perms = [
+            (rng.randrange(1, self.PRIME), rng.randrange(self.PRIME))
+            for _ in range(self.NUM_PERM)
+        ]
+        # 条目ID -> (写入时间, 归一化查询, 签名, 缓存值)
+        self._entries: OrderedDict = OrderedDict()
+        self._buckets: Dict[int, List[int]] = {}
+        self._by_query: Dict[str, int] = {}
+        self._ids = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        text = QUERY_PUNCTUATION.sub("", query.lower())
+        text = QUERY_SYNONYM_PATTERN.sub(lambda m: QUERY_SYNONYMS[m.group(0)], text)
+        return QUERY_FILLERS.sub("", text) or text
+
+    @staticmethod
+    def shingles(text: str) -> set:
+        shingles = set(text)
+        shingles.update(text[i : i + 2] for i in range(len(text) - 1))
+        return shingles
+
+    def signature(self, shingles: set) -> array:
+        hashes = [hash(shingle) & self.PRIME for shingle in shingles]
+        prime = self.PRIME
+        return array(
+            "Q", (min((a * h + b) % prime for h in hashes) for a, b in self._perms)
+        )
+
+    def _band_keys(self, signature: array) -> List[int]:
+        rows = self.ROWS
+        return [
+            hash((band, signature[band * rows : (band + 1) * rows].tobytes()))
+            for band in range(self.BANDS)
+        ]
+
+    def _remove(self, entry_id: int):
+        _, normalized, signature, _ = self._entries.pop(entry_id)
+        self._by_query.pop(normalized, None)
+        for key in self._band_keys(signature):
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                continue
+            bucket.remove(entry_id)
+            if not bucket:
+                del self._buckets[key]
+
+    def _expire(self):
+        cutoff = time.monotonic() - self.ttl
+        while self._entries:
+            entry_id, entry = next(iter(self._entries.items()))
+            if entry[0] > cutoff:
+                break
+            self._remove(entry_id)
+
+    def get(self, query: str) -> Optional[Tuple[Any, float, str]]:
+        """返回 (缓存值, 相似度, 命中的查询)，没有足够相似的新鲜条目时返回None"""
+        normalized = self.normalize(query)
+        if not normalized:
+            return None
+        self._expire()
+        shingles = self.shingles(normalized)
+        signature = self.signature(shingles)
+        best_id, best_score = None, 0.0
+        seen = set()
+        for key in self._band_keys(signature):
+            for entry_id in self._buckets.get(key, ()):
+                if entry_id in seen:
+                    continue
+                seen.add(entry_id)
+                # LSH只负责筛选候选，MinHash估计有误差，用精确的Jaccard相似度确认，
+                # 避免“iphone 15 价格”命中“iphone 16 价格”这类近似但不同的查询
+                other = self.shingles(self._entries[entry_id][1])
+                score = len(shingles & other) / len(shingles | other)
+                if score > best_score:
+                    best_id, best_score = entry_id, score
+        if best_id is None or best_score < self.threshold:
+            return None
+        _, cached_query, _, value = self._entries[best_id]
+        return value, best_score, cached_query
+
+    def set(self, query: str, value: Any):
+        normalized = self.normalize(query)
+        if not normalized or self.size <= 0:
+            return
+        if normalized in self._by_query:
+            self._remove(self._by_query[normalized])
+        signature = self.signature(self.shingles(normalized))
+        entry_id = next(self._ids)
+        self._entries[entry_id] = (time.monotonic(), normalized, signature, value)
+        self._by_query[normalized] = entry_id
+        for key in self._band_keys(signature):
+            self._buckets.setdefault(key, []).append(entry_id)
+        self._expire()
+        while len(self._entries) > self.size:
+            self._remove(next(iter(self._entries)))
 
 
 class Tools:
     # 定义常量
     DEFAULT_ENDPOINT_PATH = "v1beta/models/{model}:generateContent"
+    STREAM_ENDPOINT_PATH = "v1beta/models/{model}:streamGenerateContent"
+    # 流式预览状态的最短更新间隔（秒）
+    STREAM_STATUS_INTERVAL = 0.3
+    # 引用来源中的谷歌跳转链接标记
+    REDIRECT_MARKER = "grounding-api-redirect"
+    # 跳转链接缓存的最大条目数
+    REDIRECT_CACHE_SIZE = 4096
 
     class Valves(BaseModel):
         api_url: str = Field(
@@ -27,14 +226,41 @@ class Tools:
         )
         api_key: str = Field("", description="Gemini API密钥")
         model: str = Field("gemini-2.0-flash-exp", description="Gemini模型名称")
+        stream: bool = Field(
+            False, description="使用streamGenerateContent流式搜索，边生成边显示结果"
+        )
+        stream_output: str = Field(
+            "status",
+            description="流式文本的转发方式：status（状态栏预览）或 message（直接输出到消息）",
+        )
+        resolve_redirects: bool = Field(
+            False, description="将引用来源的谷歌跳转链接解析为真实URL"
+        )
+        redirect_concurrency: int = Field(8, description="解析跳转链接的最大并发数")
+        redirect_timeout: float = Field(5, description="解析单个跳转链接的超时时间（秒）")
+        redirect_cache_ttl: int = Field(3600, description="跳转链接解析结果的缓存时间（秒）")
+        semantic_cache: bool = Field(
+            False, description="相似查询直接返回近期的搜索结果（如“今日新闻”和“今天有什么新闻”）"
+        )
+        semantic_cache_threshold: float = Field(
+            0.8, description="判定为相似查询的最低相似度（0~1）"
+        )
+        semantic_cache_ttl: int = Field(600, description="搜索结果的缓存时间（秒）")
+        semantic_cache_size: int = Field(10000, description="最多缓存的查询数")
 
     def __init__(self):
         self.valves = self.Valves()
         # 禁用自动引用，使用自定义引用处理
         self.citation = False
+        # 跳转链接 -> (过期时间, 真实URL)
+        self._redirect_cache: OrderedDict = OrderedDict()
+        self._answer_cache = SemanticCache()
 
-    def _build_api_url(self) -> str:
+    def _build_api_url(self, stream: bool = False) -> str:
         """构建完整的API URL"""
+        if stream:
+            endpoint_path = self.STREAM_ENDPOINT_PATH.format(model=self.valves.model)
+            return f"{self.valves.api_url}/{endpoint_path}?alt=sse&key={self.valves.api_key}"
         endpoint_path = self.DEFAULT_ENDPOINT_PATH.format(model=self.valves.model)
         return f"{self.valves.api_url}/{endpoint_path}?key={self.valves.api_key}"
 
@@ -94,6 +320,126 @@ class Tools:
             }
         )
 
+    async def _stream_search(
+        self,
+        payload: Dict,
+        query: str,
+        __event_emitter__: Callable[[dict], Any],
+    ) -> Dict:
+        """流式请求搜索结果，转发生成中的文本，并返回与非流式响应结构相同的结果"""
+        texts = []
+        grounding = GroundingAccumulator()
+        last = {}
+        finish_reason = None
+        last_status = 0.0
+
+        async with aiohttp.ClientSession() as session:
+            async with session.post(self._build_api_url(stream=True), json=payload) as response:
+                response.raise_for_status()
+                async for raw_line in response.content:
+                    line = raw_line.decode("utf-8").strip()
+                    if not line.startswith("data:"):
+                        continue
+                    data = json.loads(line[5:].strip())
+                    last = data
+                    if not data.get("candidates"):
+                        continue
+                    candidate = data["candidates"][0]
+                    finish_reason = candidate.get("finishReason", finish_reason)
+
+                    sources = len(grounding.chunks)
+                    if candidate.get("groundingMetadata"):
+                        grounding.add(candidate["groundingMetadata"])
+
+                    delta = "".join(
+                        part.get("text", "")
+                        for part in candidate.get("content", {}).get("parts", [])
+                    )
+                    if delta:
+                        texts.append(delta)
+                        if self.valves.stream_output == "message":
+                            await self._emit_message(__event_emitter__, delta)
+
+                    now = time.monotonic()
+                    if self.valves.stream_output != "message" and (
+                        len(grounding.chunks) != sources
+                        or now - last_status >= self.STREAM_STATUS_INTERVAL
+                    ):
+                        last_status = now
+                        preview = "".join(texts)[-40:].replace("\n", " ")
+                        await self._emit_status(
+                            __event_emitter__,
+                            "searching",
+                            f"正在搜索: {query}（{len(grounding.chunks)} 个来源）{preview}",
+                        )
+
+        if not texts:
+            return {"candidates": []}
+        candidate = {
+            "content": {"parts": [{"text": "".join(texts)}], "role": "model"},
+            "finishReason": finish_reason,
+            "groundingMetadata": grounding.metadata(),
+        }
+        result = {"candidates": [candidate]}
+        for name in ("usageMetadata", "modelVersion"):
+            if name in last:
+                result[name] = last[name]
+        return result
+
+    async def _resolve_redirects(self, chunks: List[Dict]):
+        """并发解析引用来源中的跳转链接，原地替换为真实URL
+
+        只发送HEAD请求读取Location，不跟随跳转；解析失败的链接保持原样且不缓存。"""
+        uris = {
+            chunk["web"]["uri"]
+            for chunk in chunks
+            if self.REDIRECT_MARKER in chunk.get("web", {}).get("uri", "")
+        }
+        if not uris:
+            return
+
+        now = time.monotonic()
+        resolved = {}
+        pending = []
+        for uri in uris:
+            cached = self._redirect_cache.get(uri)
+            if cached and cached[0] > now:
+                self._redirect_cache.move_to_end(uri)
+                resolved[uri] = cached[1]
+            else:
+                pending.append(uri)
+
+        if pending:
+            semaphore = asyncio.Semaphore(max(1, self.valves.redirect_concurrency))
+            timeout = aiohttp.ClientTimeout(total=self.valves.redirect_timeout)
+
+            async def resolve(session: aiohttp.ClientSession, uri: str) -> Tuple[str, Optional[str]]:
+                async with semaphore:
+                    try:
+                        async with session.head(uri, allow_redirects=False) as response:
+                            location = response.headers.get("Location")
+                            if 300 <= response.status < 400 and location:
+                                return uri, urljoin(uri, location)
+                    except Exception:
+                        pass
+                return uri, None
+
+            async with aiohttp.ClientSession(timeout=timeout) as session:
+                results = await asyncio.gather(*(resolve(session, uri) for uri in pending))
+
+            expires = time.monotonic() + self.valves.redirect_cache_ttl
+            for uri, final_url in results:
+                if final_url:
+                    resolved[uri] = final_url
+                    self._redirect_cache[uri] = (expires, final_url)
+            while len(self._redirect_cache) > self.REDIRECT_CACHE_SIZE:
+                self._redirect_cache.popitem(last=False)
+
+        for chunk in chunks:
+            web = chunk.get("web", {})
+            if web.get("uri") in resolved:
+                web["uri"] = resolved[web["uri"]]
+
     # 移除_extract_context方法，因为不再需要基于上下文优化搜索查询
 
     def _process_grounding_supports(
@@ -144,6 +490,43 @@ class Tools:
         :param __event_emitter__: 状态更新事件发射器
         :return: 搜索结果（JSON字符串格式）
         """
+        if not self.valves.semantic_cache:
+            return await self._search(query, __event_emitter__)
+
+        cache = self._answer_cache
+        cache.size = self.valves.semantic_cache_size
+        cache.ttl = self.valves.semantic_cache_ttl
+        cache.threshold = self.valves.semantic_cache_threshold
+        hit = cache.get(query)
+        if hit:
+            (result, events), score, cached_query = hit
+            # 重放引用和引用列表，界面与实际搜索时一致
+            for event in events:
+                await __event_emitter__(event)
+            await self._emit_status(
+                __event_emitter__,
+                "completed",
+                f"搜索完成: {query}（相似查询“{cached_query}”的缓存结果，相似度 {score:.2f}）",
+                True,
+            )
+            return result
+
+        events = []
+
+        async def recording_emitter(event: dict):
+            if event.get("type") in ("citation", "message"):
+                events.append(event)
+            await __event_emitter__(event)
+
+        result = await self._search(query, recording_emitter)
+        if "error" not in json.loads(result):
+            cache.set(query, (result, events))
+        return result
+
+    async def _search(
+        self, query: str, __event_emitter__: Callable[[dict], Any]
+    ) -> str:
+        """执行实际的搜索请求并处理引用信息"""
         # 直接使用用户提供的查询，不再基于上下文优化
         search_query = query
 
@@ -178,9 +561,19 @@ class Tools:
             }
 
             # 发送请求
-            response = requests.post(api_url, json=payload)
-            response.raise_for_status()
-            result = response.json()
+            if self.valves.stream:
+                result = await self._stream_search(payload, query, __event_emitter__)
+            else:
+                response = requests.post(api_url, json=payload)
+                response.raise_for_status()
+                result = response.json()
+
+            if self.valves.resolve_redirects and result.get("candidates"):
+                await self._resolve_redirects(
+                    result["candidates"][0]
+                    .get("groundingMetadata", {})
+                    .get("groundingChunks", [])
+                )
 
             if result.get("candidates") and len(result["candidates"]) > 0:
                 candidate = result["candidates"][0]
@@ -321,3 +714,167 @@ class Tools:
             await self._emit_status(__event_emitter__, "error", error_msg, True)
 
             return json.dumps({"error": error_msg})
+
+
+class SemanticCacheTest(unittest.TestCase):
+    def test_paraphrase_hits(self):
+        cache = SemanticCache()
+        cache.set("今日新闻", "news")
+        for query in ("今天有什么新闻", "今天的新闻", "请问今日新闻？"):
+            hit = cache.get(query)
+            self.assertIsNotNone(hit, query)
+            self.assertEqual("news", hit[0])
+        self.assertIsNone(cache.get("上海天气"))
+
+    def test_similar_but_different_queries_miss(self):
+        # 估计相似度可能超过阈值，但精确Jaccard约为0.73
+        for _ in range(20):
+            cache = SemanticCache()
+            cache.set("iphone 15 价格", "15")
+            self.assertIsNone(cache.get("iphone 16 价格"))
+            self.assertEqual("15", cache.get("iPhone 15 价格")[0])
+
+    def test_ttl_and_size(self):
+        cache = SemanticCache(size=2, ttl=600)
+        for query in ("北京天气", "上海天气", "广州天气"):
+            cache.set(query, query)
+        self.assertEqual(2, len(cache))
+        self.assertIsNone(cache.get("北京天气"))
+        cache.ttl = 0
+        self.assertIsNone(cache.get("广州天气"))
+        self.assertEqual(0, len(cache))
+
+
+class RedirectHandler(BaseHTTPRequestHandler):
+    """Stub for grounding redirect links, counting HEAD requests per path."""
+
+    LOCATIONS = {
+        "/grounding-api-redirect/a": "https://example.com/a",
+        "/grounding-api-redirect/b": "https://example.org/b?x=1",
+        "/grounding-api-redirect/relative": "/real/page",
+    }
+    heads: Dict[str, int] = {}
+
+    def do_HEAD(self):
+        self.heads[self.path] = self.heads.get(self.path, 0) + 1
+        location = self.LOCATIONS.get(self.path)
+        if location is None:
+            self.send_response(404)
+        else:
+            self.send_response(302)
+            self.send_header("Location", location)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ResolveRedirectsTest(unittest.IsolatedAsyncioTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), RedirectHandler)
+        cls.base_url = f"http://127.0.0.1:{cls.server.server_address[1]}"
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        RedirectHandler.heads.clear()
+
+    def chunks(self) -> List[Dict]:
+        paths = ["a", "b", "relative", "missing"]
+        chunks = [
+            {"web": {"uri": f"{self.base_url}/grounding-api-redirect/{path}", "title": path}}
+            for path in paths
+        ]
+        chunks.append({"web": {"uri": "https://example.net/direct", "title": "direct"}})
+        return chunks
+
+    async def test_resolve_redirects(self):
+        tools = Tools()
+        chunks = self.chunks()
+        await tools._resolve_redirects(chunks)
+        self.assertEqual(
+            [
+                "https://example.com/a",
+                "https://example.org/b?x=1",
+                f"{self.base_url}/real/page",
+                f"{self.base_url}/grounding-api-redirect/missing",
+                "https://example.net/direct",
+            ],
+            [chunk["web"]["uri"] for chunk in chunks],
+        )
+        # Failed lookups keep the original link and are not cached
+        self.assertNotIn(chunks[3]["web"]["uri"], tools._redirect_cache)
+        self.assertEqual(3, len(tools._redirect_cache))
+
+    async def test_cache_skips_second_head(self):
+        tools = Tools()
+        await tools._resolve_redirects(self.chunks())
+        chunks = self.chunks()
+        await tools._resolve_redirects(chunks)
+        self.assertEqual("https://example.com/a", chunks[0]["web"]["uri"])
+        self.assertEqual(1, RedirectHandler.heads["/grounding-api-redirect/a"])
+        self.assertEqual(1, RedirectHandler.heads["/grounding-api-redirect/b"])
+        self.assertEqual(2, RedirectHandler.heads["/grounding-api-redirect/missing"])
+
+    async def test_cache_expires(self):
+        tools = Tools()
+        tools.valves.redirect_cache_ttl = 0
+        await tools._resolve_redirects(self.chunks())
+        await tools._resolve_redirects(self.chunks())
+        self.assertEqual(2, RedirectHandler.heads["/grounding-api-redirect/a"])
+
+
+def benchmark_semantic_cache(entries: int = 100_000, probes: int = 2000):
+    """python google_search_tools.py --bench：写入entries条随机中文查询后测量查找耗时"""
+    rng = random.Random(1)
+    chars = [chr(c) for c in range(0x4E00, 0x4E00 + 3000)]
+    words = [
+        "".join(rng.choice(chars) for _ in range(rng.choice((2, 2, 3, 4))))
+        for _ in range(5000)
+    ]
+    queries = [
+        "".join(rng.choice(words) for _ in range(rng.randint(2, 5)))
+        for _ in range(entries)
+    ]
+    cache = SemanticCache(size=entries, ttl=3600)
+    start = time.perf_counter()
+    for i, query in enumerate(queries):
+        cache.set(query, i)
+    insert = (time.perf_counter() - start) / entries
+    print(
+        f"entries {len(cache)}, insert {insert * 1e6:.1f}us, "
+        f"max bucket {max(map(len, cache._buckets.values()))}"
+    )
+    cases = {
+        "exact": rng.sample(queries, probes),
+        "paraphrase": ["请问" + q + "有什么" for q in rng.sample(queries, probes)],
+        "miss": [
+            "".join(rng.choice(words) for _ in range(3)) for _ in range(probes)
+        ],
+    }
+    for name, batch in cases.items():
+        times, hits = [], 0
+        for query in batch:
+            start = time.perf_counter()
+            hits += cache.get(query) is not None
+            times.append(time.perf_counter() - start)
+        times.sort()
+        print(
+            f"{name}: p50 {times[len(times) // 2] * 1e6:.0f}us, "
+            f"p99 {times[int(len(times) * 0.99)] * 1e6:.0f}us, "
+            f"hit rate {hits / len(batch):.3f}"
+        )
+
+
+if __name__ == "__main__":
+    if "--bench" in sys.argv:
+        benchmark_semantic_cache()
+    else:
+        print("Running tests...")
+        unittest.main()
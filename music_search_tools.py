@@ -4,30 +4,268 @@ author: OpenWebUI
 author_url: https://openwebui.com
 description: 用于提供歌曲、专辑、艺术家及音乐相关信息的音乐搜索服务
 required_open_webui_version: 0.4.0
-requirements: requests
-version: 1.1.0
+requirements: aiohttp
+version: 1.4.0
 licence: MIT
 """
 
-import requests
+import aiohttp
+import asyncio
 import json
+import time
+from collections import OrderedDict
 from typing import Optional, List, Dict, Any
 from pydantic import BaseModel, Field
 from datetime import datetime
 
+
+class TTLCache:
+    """带过期时间和容量上限的LRU缓存"""
+
+    def __init__(self, maxsize: int = 256, ttl: float = 600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Any, tuple]" = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expires, value = item
+        if expires < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+
 class Tools:
+    class Valves(BaseModel):
+        request_timeout: float = Field(
+            default=10, description="音乐API请求超时时间（秒）"
+        )
+        max_connections: int = Field(
+            default=10, description="音乐API连接池的最大连接数"
+        )
+        cache_ttl: int = Field(
+            default=600, description="搜索结果与歌曲详情的缓存时间（秒）"
+        )
+        cache_size: int = Field(
+            default=256, description="搜索结果与歌曲详情缓存的最大条目数"
+        )
+        list_message_chunks: int = Field(
+            default=1, description="歌曲列表拆分发送的消息事件数量（1表示一次性发送）"
+        )
+        prefetch_enabled: bool = Field(
+            default=False, description="搜索完成后在后台预取前几首歌曲的详情与歌词"
+        )
+        prefetch_count: int = Field(
+            default=5, description="每次搜索后预取详情的歌曲数量"
+        )
+        prefetch_concurrency: int = Field(
+            default=2, description="预取详情时的最大并发请求数"
+        )
+
     class UserValves(BaseModel):
         show_lyrics: bool = Field(
             default=True, description="是否显示歌词"
         )
+        lyrics_mode: str = Field(
+            default="text",
+            description="歌词格式：lrc（带时间轴）、text（纯文本）、dedup（纯文本并省略重复段落）、head（仅前若干行）",
+        )
+        lyrics_max_lines: int = Field(
+            default=20, description="lyrics_mode为head时返回的歌词行数"
+        )
     
     def __init__(self):
         """初始化音乐搜索工具"""
         self.api_url = "https://api.lolimi.cn/API/wydg/"
+        self.valves = self.Valves()
         self.user_valves = self.UserValves()
         self.citation = False
+        self._session: Optional[aiohttp.ClientSession] = None
+        # 搜索关键词 -> 歌曲列表
+        self._search_cache = TTLCache(self.valves.cache_size, self.valves.cache_ttl)
+        # 歌曲ID -> 歌曲详情
+        self._detail_cache = TTLCache(self.valves.cache_size, self.valves.cache_ttl)
+        # (歌曲ID, 歌词格式, 行数) -> 渲染后的歌词
+        self._lyrics_cache = TTLCache(self.valves.cache_size, self.valves.cache_ttl)
+        # 用户ID -> {歌曲ID: 预取任务}
+        self._prefetch_tasks: Dict[str, Dict[Any, asyncio.Task]] = {}
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """获取共享的HTTP会话，复用连接池"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.valves.max_connections),
+                timeout=aiohttp.ClientTimeout(total=self.valves.request_timeout),
+            )
+        return self._session
+
+    async def _request(self, params: dict) -> dict:
+        """请求音乐API并解析JSON响应"""
+        async with self._get_session().get(self.api_url, params=params) as response:
+            response.raise_for_status()
+            # 接口返回的Content-Type不一定是application/json
+            return await response.json(content_type=None)
+
+    def _apply_cache_valves(self):
+        """Valves可能在初始化后被替换，使用前同步缓存配置"""
+        for cache in (self._search_cache, self._detail_cache, self._lyrics_cache):
+            cache.ttl = self.valves.cache_ttl
+            cache.maxsize = self.valves.cache_size
+
+    async def _search(self, query: str) -> dict:
+        """搜索歌曲列表，命中缓存时不请求API"""
+        self._apply_cache_valves()
+        data = self._search_cache.get(query)
+        if data is None:
+            data = await self._request({"msg": query})
+            if data.get("code") == 200 and data.get("data"):
+                self._search_cache.set(query, data)
+        return data
+
+    async def _song_detail(self, query: str, song_number: int) -> dict:
+        """获取歌曲详情，按歌曲ID缓存"""
+        self._apply_cache_valves()
+        songs = (self._search_cache.get(query) or {}).get("data") or []
+        song_id = None
+        if 0 < song_number <= len(songs):
+            song_id = songs[song_number - 1].get("id")
+            data = self._detail_cache.get(song_id)
+            if data is not None:
+                return data
+        data = await self._request({"msg": query, "n": song_number})
+        if data.get("code") == 200:
+            # 查找和预取都用列表中的ID，详情接口返回的ID类型可能不同（int/str），只作后备
+            key = song_id if song_id is not None else data.get("id")
+            if key is not None:
+                self._detail_cache.set(key, data)
+        return data
+    
+    def _start_prefetch(self, user_id: str, query: str, songs: List[Dict]):
+        """在后台预取前几首歌曲的详情，同一用户的新搜索会取消旧的预取"""
+        self._cancel_prefetch(user_id)
+        semaphore = asyncio.Semaphore(max(1, self.valves.prefetch_concurrency))
+        tasks = self._prefetch_tasks.setdefault(user_id, {})
+        for n, song in enumerate(songs[:self.valves.prefetch_count], 1):
+            song_id = song.get("id")
+            if song_id is None or self._detail_cache.get(song_id) is not None:
+                continue
+            task = asyncio.create_task(self._prefetch_detail(semaphore, query, n))
+            task.add_done_callback(
+                lambda t, song_id=song_id: self._discard_prefetch(user_id, song_id, t)
+            )
+            tasks[song_id] = task
+
+    async def _prefetch_detail(self, semaphore: asyncio.Semaphore, query: str, song_number: int):
+        async with semaphore:
+            try:
+                await self._song_detail(query, song_number)
+            except Exception:
+                # 预取失败不影响用户请求，get_song_detail会重新获取
+                pass
+
+    def _discard_prefetch(self, user_id: str, song_id: Any, task: asyncio.Task):
+        """预取任务结束后从任务表中移除"""
+        tasks = self._prefetch_tasks.get(user_id)
+        if tasks and tasks.get(song_id) is task:
+            del tasks[song_id]
+            if not tasks:
+                del self._prefetch_tasks[user_id]
+
+    def _cancel_prefetch(self, user_id: str):
+        """取消该用户所有未完成的预取任务"""
+        for task in self._prefetch_tasks.pop(user_id, {}).values():
+            task.cancel()
+
+    async def _await_prefetch(self, user_id: str, query: str, song_number: int):
+        """若所选歌曲正在预取则等待其完成，并取消该用户其余的预取任务"""
+        songs = (self._search_cache.get(query) or {}).get("data") or []
+        tasks = self._prefetch_tasks.get(user_id, {})
+        if 0 < song_number <= len(songs):
+            task = tasks.pop(songs[song_number - 1].get("id"), None)
+            if task is not None:
+                await asyncio.wait([task])
+        self._cancel_prefetch(user_id)
+
+    @staticmethod
+    def _render_song_list(songs: List[Dict], chunks: int = 1) -> List[str]:
+        """将歌曲列表渲染为<details>块，并拆分为至多chunks段"""
+        lines = [
+            f"{i+1}. **{song['name']}** - {song['singer']} (ID: {song['id']})\n"
+            for i, song in enumerate(songs)
+        ]
+        chunks = max(1, min(chunks, len(lines)))
+        size = -(-len(lines) // chunks)
+        parts = ["".join(lines[i:i + size]) for i in range(0, len(lines), size)]
+        parts[0] = "\n<details>\n<summary>歌曲列表</summary>\n\n" + parts[0]
+        parts[-1] += "\n</details>\n"
+        return parts
+
+    @staticmethod
+    def _render_lyrics(lyric: List[Dict], mode: str = "text", max_lines: int = 20) -> str:
+        """按指定格式一次性拼接歌词"""
+        if mode == "lrc":
+            return "".join(f"{line.get('time', '')} {line.get('name', '')}\n" for line in lyric)
+
+        lines = [line.get('name', '').strip() for line in lyric]
+        lines = [line for line in lines if line]
+        if mode == "head":
+            return "".join(f"{line}\n" for line in lines[:max_lines])
+        if mode == "dedup":
+            # 保留每行首次出现，连续的重复行折叠为一个省略标记
+            seen, output, skipping = set(), [], False
+            for line in lines:
+                if line in seen:
+                    if not skipping:
+                        output.append("（重复段落省略）")
+                        skipping = True
+                    continue
+                seen.add(line)
+                output.append(line)
+                skipping = False
+            lines = output
+        return "".join(f"{line}\n" for line in lines)
+
+    def _get_lyrics(self, data: Dict, mode: str, max_lines: int) -> str:
+        """获取渲染后的歌词，按歌曲ID与格式缓存"""
+        key = (data.get('id'), mode, max_lines if mode == "head" else None)
+        lyrics = self._lyrics_cache.get(key) if key[0] is not None else None
+        if lyrics is None:
+            lyrics = self._render_lyrics(data['lyric'], mode, max_lines)
+            if key[0] is not None:
+                self._lyrics_cache.set(key, lyrics)
+        return lyrics
+
+    @staticmethod
+    def _render_song_info(data: Dict) -> str:
+        """渲染歌曲基本信息、封面与播放链接"""
+        parts = [
+            f"### 歌曲详情\n\n"
+            f"**歌曲名**: {data.get('name', '未知')}\n"
+            f"**歌手**: {data.get('author', '未知')}\n"
+            f"**歌曲ID**: {data.get('id', '未知')}\n"
+            f"**时长**: {data.get('market', '未知')}\n"
+        ]
+        
+        # 添加封面图片
+        if data.get('img'):
+            parts.append(f"**歌曲封面**：[点击查看]({data['img']})\n")
+        
+        # 添加音乐链接
+        if data.get('mp3'):
+            parts.append(f"\n### 歌曲链接\n\n**歌曲链接**：[点击播放]({data['mp3']})\n")
+        return "".join(parts)
     
-    async def find_songs(self, query: str, __event_emitter__=None) -> str:
+    async def find_songs(self, query: str, __event_emitter__=None, __user__: dict = {}) -> str:
         """
         执行音乐搜索，获取相关音乐列表信息
 
@@ -43,10 +281,8 @@ class Tools:
                     }
                 )
             
-            # 构建API请求URL
-            params = {"msg": query}
-            response = requests.get(self.api_url, params=params)
-            data = response.json()
+            # 搜索歌曲列表（优先使用缓存）
+            data = await self._search(query)
             
             if data["code"] != 200:
                 return f"搜索失败: {data.get('msg', '未知错误')}"
@@ -55,34 +291,16 @@ class Tools:
             if not data.get("data"):
                 return "未找到相关歌曲"
             
-            # 通过事件发射器发送搜索结果标题
+            # 整个歌曲列表只渲染一次，按配置拆分为少量消息事件发送
             if __event_emitter__:
-                await __event_emitter__(
-                    {
-                        "type": "message",
-                        "data": {"content": "\n<details>\n<summary>歌曲列表</summary>\n\n"},
-                    }
-                )
-            
-            # 为每首歌曲单独发送一个事件，使用简洁的列表形式
-            for i, song in enumerate(data["data"]):
-                song_info = f"{i+1}. **{song['name']}** - {song['singer']} (ID: {song['id']})"
-                if __event_emitter__:
+                for content in self._render_song_list(data["data"], self.valves.list_message_chunks):
                     await __event_emitter__(
                         {
                             "type": "message",
-                            "data": {"content": f"{song_info}\n"},
+                            "data": {"content": content},
                         }
                     )
             
-            if __event_emitter__:
-                await __event_emitter__(
-                    {
-                        "type": "message",
-                        "data": {"content": "\n</details>\n"},
-                    }
-                )
-            
             # 发送完成状态
             if __event_emitter__:
                 await __event_emitter__(
@@ -92,6 +310,10 @@ class Tools:
                     }
                 )
 
+            # 用户选择歌曲期间在后台预取详情
+            if self.valves.prefetch_enabled:
+                self._start_prefetch(__user__.get("id", ""), query, data["data"])
+
             # 返回一个结果字符串进行提示
             result = "搜索完成，已获取歌曲列表，请根据歌曲序号告诉我想听哪一首。"
             return result
@@ -106,7 +328,7 @@ class Tools:
                 )
             return f"搜索过程中发生错误: {str(e)}"
     
-    async def get_song_detail(self, query: str, song_number: int, __event_emitter__=None) -> str:
+    async def get_song_detail(self, query: str, song_number: int, __event_emitter__=None, __user__: dict = {}) -> str:
         """
         执行某首歌曲的搜索，获取相关歌曲的详细信息
 
@@ -123,82 +345,46 @@ class Tools:
                     }
                 )
             
-            # 构建API请求URL
-            params = {"msg": query, "n": song_number}
-            response = requests.get(self.api_url, params=params)
-            data = response.json()
+            # 获取歌曲详情（优先使用预取结果与缓存）
+            await self._await_prefetch(__user__.get("id", ""), query, song_number)
+            data = await self._song_detail(query, song_number)
             
             if data["code"] != 200:
                 return f"获取详情失败: {data.get('msg', '未知错误')}"
             
-            # 构建详细信息和音乐链接，并用<details>标签包裹
+            # 歌曲基本信息只构建一次，同时用于<details>消息和返回结果
+            song_info = self._render_song_info(data)
             if __event_emitter__:
-                # 开始<details>标签
-                await __event_emitter__(
-                    {
-                        "type": "message",
-                        "data": {"content": f"\n<details>\n<summary>歌曲详情 - {data.get('name', '未知')}</summary>\n\n"},
-                    }
-                )
-                
-                # 歌曲基本信息
-                song_info = f"### 歌曲详情\n\n"
-                song_info += f"**歌曲名**: {data.get('name', '未知')}\n"
-                song_info += f"**歌手**: {data.get('author', '未知')}\n"
-                song_info += f"**歌曲ID**: {data.get('id', '未知')}\n"
-                
-                # 添加封面图片
-                if data.get('img'):
-                    song_info += f"**歌曲封面**：[点击查看]({data['img']})\n"
-                
-                # 添加音乐链接
-                if data.get('mp3'):
-                    song_info += f"\n### 歌曲链接\n\n"
-                    song_info += f"**歌曲链接**：[点击播放]({data['mp3']})\n"
-                    song_info += f"**时长**：{data.get('market', '未知')}\n"
-                
-                # 发送歌曲信息
                 await __event_emitter__(
                     {
                         "type": "message",
-                        "data": {"content": song_info},
-                    }
-                )
-                
-                # 结束<details>标签
-                await __event_emitter__(
-                    {
-                        "type": "message",
-                        "data": {"content": "\n</details>\n"},
+                        "data": {
+                            "content": f"\n<details>\n<summary>歌曲详情 - {data.get('name', '未知')}</summary>\n\n{song_info}\n</details>\n"
+                        },
                     }
                 )
             
-            # 初始化结果字符串（用于返回）
-            result = f"### 歌曲详情\n\n"
-            result += f"**歌曲名**: {data.get('name', '未知')}\n"
-            result += f"**歌手**: {data.get('author', '未知')}\n"
-            result += f"**歌曲ID**: {data.get('id', '未知')}\n"
-            result += f"**时长**: {data.get('market', '未知')}\n"
+            result_parts = [song_info]
             
             # 添加评论（不包含在details中）
             if data.get('review'):
                 review = data['review']
-                result += f"\n### 热门评论\n\n"
-                result += f"**用户**: {review.get('nickname', '未知')}\n"
-                result += f"**时间**: {review.get('timeStr', '未知')}\n"
-                result += f"**内容**: {review.get('content', '未知')}\n"
+                result_parts.append(
+                    f"\n### 热门评论\n\n"
+                    f"**用户**: {review.get('nickname', '未知')}\n"
+                    f"**时间**: {review.get('timeStr', '未知')}\n"
+                    f"**内容**: {review.get('content', '未知')}\n"
+                )
             
             # 添加歌词（不包含在details中）
-            if self.user_valves.show_lyrics and data.get('lyric'):
-                result += f"\n### 歌词\n\n"
-                for line in data['lyric']:
-                    result += f"{line.get('time', '')} {line.get('name', '')}\n"
+            user_valves = __user__.get("valves") or self.user_valves
+            if user_valves.show_lyrics and data.get('lyric'):
+                result_parts.append(f"\n### 歌词\n\n")
+                result_parts.append(
+                    self._get_lyrics(data, user_valves.lyrics_mode, user_valves.lyrics_max_lines)
+                )
             
-            # 添加音乐链接（已在details中添加，这里为了保持返回结果的完整性也添加）
-            if data.get('mp3'):
-                result += f"\n### 歌曲链接\n\n"
-                result += f"**歌曲链接**：[点击播放]({data['mp3']})\n"
-                result += f"**时长**：{data.get('market', '未知')}\n"
+            result = "".join(result_parts)
             
             # 添加引用
             if __event_emitter__:
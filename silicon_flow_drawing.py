@@ -1,11 +1,25 @@
 import asyncio
+import hashlib
+import json
+import logging
+import mimetypes
+import os
 import random
 import re
-from typing import Callable, Awaitable, Any, Optional
+import time
+from collections import OrderedDict
+from typing import Callable, Awaitable, Any, Dict, List, Optional
 
 import aiohttp
 from pydantic import BaseModel, Field
 
+log = logging.getLogger(__name__)
+
+MARKDOWN_IMAGE_REGEX = re.compile(r"!\[.*?\]\([^)]*\)")
+
+# 可重试的HTTP状态码，其余4xx错误重试也不会成功
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+
 
 class AIOutput(BaseModel):
     success: bool
@@ -14,11 +28,100 @@ class AIOutput(BaseModel):
     height: int
     reason: Optional[str] = None
     seed: int = Field(default=-1)
+    batch_size: int = Field(default=1)
+
+
+class JSONObjectScanner:
+    """
+    增量扫描文本中的顶层JSON对象（按花括号配平，忽略字符串内的括号），
+    可分块喂入流式输出，总耗时与文本长度成线性关系。
+    """
+
+    OBJECT_SPECIAL = re.compile(r'[{}"]')
+    STRING_SPECIAL = re.compile(r'["\\]')
+
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.buffer: List[str] = []
+
+    def feed(self, chunk: str) -> List[str]:
+        """喂入一段文本，返回其中已闭合的完整JSON对象字符串"""
+        objects = []
+        start = 0 if self.depth else None
+        pos, end = 0, len(chunk)
+        while pos < end:
+            if not self.depth:
+                pos = chunk.find("{", pos)
+                if pos < 0:
+                    break
+                start, self.depth = pos, 1
+                pos += 1
+            elif self.escape:
+                self.escape = False
+                pos += 1
+            elif self.in_string:
+                match = self.STRING_SPECIAL.search(chunk, pos)
+                if not match:
+                    break
+                pos = match.end()
+                if match.group() == "\\":
+                    self.escape = True
+                else:
+                    self.in_string = False
+            else:
+                match = self.OBJECT_SPECIAL.search(chunk, pos)
+                if not match:
+                    break
+                pos = match.end()
+                char = match.group()
+                if char == '"':
+                    self.in_string = True
+                elif char == "{":
+                    self.depth += 1
+                else:
+                    self.depth -= 1
+                    if not self.depth:
+                        self.buffer.append(chunk[start:pos])
+                        objects.append("".join(self.buffer))
+                        self.buffer = []
+                        start = None
+        if self.depth and start is not None:
+            self.buffer.append(chunk[start:])
+        return objects
+
+
+def parse_ai_outputs(objects: List[str]) -> tuple:
+    """从JSON对象字符串中解析AIOutput，返回(解析结果列表, 最后一个解析错误)"""
+    ai_outputs, error = [], None
+    for text in objects:
+        # 快速过滤明显不是AIOutput的JSON对象，避免完整校验
+        if '"prompt"' not in text or '"success"' not in text:
+            continue
+        try:
+            ai_outputs.append(AIOutput.model_validate_json(text))
+        except Exception as e:
+            error = e
+    return ai_outputs, error
+
+
+class EarlyGeneration:
+    """流式阶段已启动的图片生成任务"""
+
+    def __init__(self, max_concurrency: int):
+        self.started = time.monotonic()
+        self.jobs: List[AIOutput] = []
+        self.tasks: List[asyncio.Task] = []
+        self.scanner = JSONObjectScanner()
+        self.semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    def cancel(self):
+        for task in self.tasks:
+            task.cancel()
 
 
 class Filter:
-    # 使用您提供的正则表达式，转换为 Python 格式
-    JSON_REGEX = re.compile(r"\{(?:\\.|[^\\}])*}")
 
     class Valves(BaseModel):
         priority: int = Field(default=0, description="用于过滤操作的优先级别。")
@@ -34,6 +137,62 @@ class Filter:
             default=3,
             description="HTTP请求的最大重试次数。",
         )
+        retry_backoff: float = Field(
+            default=1.0,
+            description="重试退避的基础等待时间（秒），每次重试翻倍并加入随机抖动。",
+        )
+        key_cooldown: float = Field(
+            default=60.0,
+            description="API密钥被限流（429）后暂停使用的时间（秒）。",
+        )
+        connect_timeout: float = Field(
+            default=10.0,
+            description="建立连接的超时时间（秒）。",
+        )
+        read_timeout: float = Field(
+            default=120.0,
+            description="等待图像生成响应的超时时间（秒）。",
+        )
+        max_batch_size: int = Field(
+            default=4,
+            description="单次回复最多生成的图片数量。",
+        )
+        max_concurrency: int = Field(
+            default=2,
+            description="同时进行的图片生成请求数。",
+        )
+        progressive_delivery: bool = Field(
+            default=True,
+            description="先显示占位内容，每张图片生成完成后立即显示。",
+        )
+        status_interval: float = Field(
+            default=2.0,
+            description="生成过程中刷新状态（已用时间）的间隔（秒）。",
+        )
+        cache_ttl: int = Field(
+            default=3300,
+            description="相同参数生成结果的缓存时间（秒），应略短于Siliconflow图片链接的有效期（1小时）。",
+        )
+        cache_size: int = Field(
+            default=128,
+            description="生成结果缓存的最大条目数，超出时淘汰最久未使用的条目。",
+        )
+        early_start: bool = Field(
+            default=True,
+            description="流式输出中一旦出现完整的JSON即开始生成图片，无需等待回复结束。",
+        )
+        mirror_dir: str = Field(
+            default="",
+            description="（可选）图片本地镜像目录，与mirror_url_prefix同时设置后会下载图片保存到此目录，缓存不再受临时链接过期限制。",
+        )
+        mirror_url_prefix: str = Field(
+            default="",
+            description="本地镜像目录对外访问的URL前缀（例如：/cache/image/generations），未设置时不启用镜像。",
+        )
+        mirror_cache_ttl: int = Field(
+            default=7 * 24 * 3600,
+            description="启用本地镜像时生成结果的缓存时间（秒）。",
+        )
         num_inference_steps: int = Field(
             default=20,
             description="执行的推理步骤数。（1-100）",
@@ -45,11 +204,72 @@ class Filter:
 
     def __init__(self):
         self.valves = self.Valves()
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._key_index = random.randrange(1 << 16)
+        # API密钥 -> 冷却结束时间
+        self._key_cooldowns: Dict[str, float] = {}
+        # (chat_id, message_id) -> 流式阶段已启动的生成任务
+        self._early_generations: Dict[tuple, EarlyGeneration] = {}
+        # 消息内容 -> 移除图片后的内容，按最近使用排序（以内容本身的哈希为键）
+        self._stripped_cache: "OrderedDict[str, str]" = OrderedDict()
+        # 生成参数哈希 -> (过期时间, 响应数据)，按最近使用排序
+        self._image_cache: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """获取共享的HTTP会话，复用连接池"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(
+                    connect=self.valves.connect_timeout,
+                    sock_read=self.valves.read_timeout,
+                )
+            )
+        return self._session
+
+    def _api_keys(self) -> List[str]:
+        keys = [key.strip() for key in self.valves.Siliconflow_API_KEY.split(",")]
+        keys = [key for key in keys if key]
+        if not keys:
+            raise ValueError("未配置Siliconflow API密钥。")
+        return keys
+
+    def _next_api_key(self) -> str:
+        """轮换选择API密钥，跳过冷却中的密钥；全部冷却时选择最早恢复的"""
+        keys = self._api_keys()
+        now = time.monotonic()
+        for _ in range(len(keys)):
+            self._key_index += 1
+            key = keys[self._key_index % len(keys)]
+            if self._key_cooldowns.get(key, 0) <= now:
+                return key
+        return min(keys, key=lambda key: self._key_cooldowns.get(key, 0))
+
+    def _has_ready_key(self) -> bool:
+        now = time.monotonic()
+        return any(self._key_cooldowns.get(key, 0) <= now for key in self._api_keys())
+
+    def _backoff_delay(self, attempt: int) -> float:
+        """指数退避加全抖动"""
+        return random.uniform(0, self.valves.retry_backoff * (2**attempt))
 
     @staticmethod
     def remove_markdown_images(content: str) -> str:
         # 根据需要调整，确保保留JSON格式
-        return re.sub(r"!\[.*?\]\([^)]*\)", "", content)
+        return MARKDOWN_IMAGE_REGEX.sub("", content)
+
+    def strip_images(self, content: str) -> str:
+        """移除Markdown图片；不含图片的内容直接跳过，处理过的内容直接取缓存结果"""
+        if "![" not in content:
+            return content
+        stripped = self._stripped_cache.get(content)
+        if stripped is not None:
+            self._stripped_cache.move_to_end(content)
+            return stripped
+        stripped = self.remove_markdown_images(content)
+        self._stripped_cache[content] = stripped
+        while len(self._stripped_cache) > 2048:
+            self._stripped_cache.popitem(last=False)
+        return stripped
 
     async def inlet(
         self,
@@ -67,10 +287,61 @@ class Filter:
                 },
             }
         )
-        for i, msg in enumerate(body["messages"]):
-            body["messages"][i]["content"] = self.remove_markdown_images(msg["content"])
+        for msg in body["messages"]:
+            content = msg.get("content")
+            if isinstance(content, str):
+                msg["content"] = self.strip_images(content)
+            elif isinstance(content, list):
+                # 多模态消息只处理文本部分，原地修改
+                for part in content:
+                    if part.get("type") == "text" and isinstance(part.get("text"), str):
+                        part["text"] = self.strip_images(part["text"])
         return body
 
+    @staticmethod
+    def generation_key(body: Optional[dict], __metadata__: Optional[dict]) -> tuple:
+        metadata = __metadata__ or {}
+        body = body or {}
+        return (
+            metadata.get("chat_id", body.get("chat_id")),
+            metadata.get("message_id", body.get("id")),
+        )
+
+    def stream(self, event: dict, __metadata__: Optional[dict] = None) -> dict:
+        """流式输出中一旦出现完整的AIOutput JSON，立即开始生成图片"""
+        if not self.valves.early_start:
+            return event
+        key = self.generation_key(None, __metadata__)
+        # 没有会话和消息ID时无法与outlet对应（例如API直接调用），不提前生成，
+        # 否则并发的流会共用同一个解析器，生成的图片也无人领取
+        if None in key:
+            return event
+        try:
+            delta = event["choices"][0]["delta"].get("content") or ""
+        except (KeyError, IndexError, TypeError, AttributeError):
+            return event
+        if not delta:
+            return event
+
+        now = time.monotonic()
+        # 清理未进入outlet（例如用户中止）的过期任务
+        for stale in [k for k, v in self._early_generations.items() if now - v.started > 600]:
+            self._early_generations.pop(stale).cancel()
+        early = self._early_generations.get(key)
+        if early is None:
+            early = EarlyGeneration(self.valves.max_concurrency)
+            self._early_generations[key] = early
+
+        ai_outputs, _ = parse_ai_outputs(early.scanner.feed(delta))
+        for job in self.expand_batch([o for o in ai_outputs if o.success]):
+            if len(early.jobs) >= max(1, self.valves.max_batch_size):
+                break
+            early.jobs.append(job)
+            early.tasks.append(
+                asyncio.create_task(self.generate_image_url(job, early.semaphore))
+            )
+        return event
+
     async def text_to_image(
         self, prompt: str, image_size: str, seed: int, __user__: Optional[dict] = None
     ):
@@ -83,25 +354,96 @@ class Filter:
             "num_inference_steps": self.valves.num_inference_steps,  # 保持推理步数
         }
 
-        headers = {
-            "authorization": f"Bearer {random.choice([key for key in self.valves.Siliconflow_API_KEY.split(',') if key])}",
-            "accept": "application/json",
-            "content-type": "application/json",
-        }
+        session = self._get_session()
+        error = "未知错误"
+        for attempt in range(self.valves.max_retries):
+            api_key = self._next_api_key()
+            headers = {
+                "authorization": f"Bearer {api_key}",
+                "accept": "application/json",
+                "content-type": "application/json",
+            }
+            rate_limited = False
+            try:
+                async with session.post(url, json=payload, headers=headers) as response:
+                    if response.status == 200:
+                        return await response.json()
+                    error = f"HTTP {response.status}: {await response.text()}"
+                    if response.status == 429:
+                        rate_limited = True
+                        retry_after = response.headers.get("Retry-After", "")
+                        self._key_cooldowns[api_key] = time.monotonic() + (
+                            float(retry_after)
+                            if retry_after.isdigit()
+                            else self.valves.key_cooldown
+                        )
+                    if response.status not in RETRYABLE_STATUSES:
+                        log.warning("Siliconflow request failed: %s", error)
+                        return {"error": error}
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = f"{type(e).__name__}: {e}"
+
+            log.warning(
+                "Siliconflow attempt %d/%d failed: %s",
+                attempt + 1,
+                self.valves.max_retries,
+                error,
+            )
+            if attempt < self.valves.max_retries - 1:
+                # 被限流时若还有可用密钥，直接换密钥重试
+                if not (rate_limited and self._has_ready_key()):
+                    await asyncio.sleep(self._backoff_delay(attempt))
+        return {"error": error}
+
+    def cache_key(self, ai_output: AIOutput) -> str:
+        """按生成参数计算缓存键，参数完全一致时生成的图片相同"""
+        params = [
+            ai_output.prompt,
+            ai_output.width,
+            ai_output.height,
+            ai_output.seed,
+            self.valves.model_name,
+            self.valves.num_inference_steps,
+        ]
+        return hashlib.sha256(json.dumps(params).encode("utf-8")).hexdigest()
+
+    def get_cached_image(self, key: str) -> Optional[dict]:
+        item = self._image_cache.get(key)
+        if item is None:
+            return None
+        if item[0] < time.monotonic():
+            del self._image_cache[key]
+            return None
+        self._image_cache.move_to_end(key)
+        return item[1]
+
+    def set_cached_image(self, key: str, response_data: dict, ttl: float):
+        self._image_cache[key] = (time.monotonic() + ttl, response_data)
+        self._image_cache.move_to_end(key)
+        while len(self._image_cache) > max(0, self.valves.cache_size):
+            self._image_cache.popitem(last=False)
 
-        async with aiohttp.ClientSession() as session:
-            for attempt in range(self.valves.max_retries):
-                try:
-                    async with session.post(
-                        url, json=payload, headers=headers
-                    ) as response:
-                        response.raise_for_status()
-                        response_data = await response.json()
-                        return response_data
-                except Exception as e:
-                    print(f"Attempt {attempt + 1} failed: {e}")
-                    if attempt == self.valves.max_retries - 1:
-                        return {"error": str(e)}
+    async def mirror_image(self, key: str, image_url: str) -> Optional[str]:
+        """下载图片到本地镜像目录，返回镜像URL；失败时返回None"""
+        try:
+            async with self._get_session().get(image_url) as response:
+                response.raise_for_status()
+                data = await response.read()
+                content_type = response.headers.get("Content-Type", "").split(";")[0]
+            extension = mimetypes.guess_extension(content_type) or ".png"
+            filename = f"{key}{extension}"
+            os.makedirs(self.valves.mirror_dir, exist_ok=True)
+            path = os.path.join(self.valves.mirror_dir, filename)
+            await asyncio.to_thread(self._write_file, path, data)
+            return f"{self.valves.mirror_url_prefix.rstrip('/')}/{filename}"
+        except Exception as e:
+            log.warning("Mirroring image %s failed: %s", image_url, e)
+            return None
+
+    @staticmethod
+    def _write_file(path: str, data: bytes):
+        with open(path, "wb") as f:
+            f.write(data)
 
     async def generate_single_image(
         self, ai_output: AIOutput, __user__: Optional[dict] = None
@@ -111,20 +453,164 @@ class Filter:
             ai_output.seed = random.randint(0, 9999999999)
         seed = ai_output.seed
 
+        key = self.cache_key(ai_output)
+        cached = self.get_cached_image(key)
+        if cached is not None:
+            return cached
+
         result = await self.text_to_image(ai_output.prompt, image_size, seed, __user__)
 
         if isinstance(result, dict) and "error" in result:
             error_message = result["error"]
             raise Exception(f"Siliconflow API Error: {error_message}")
 
+        images = (result or {}).get("images") or []
+        if not images:
+            return result
+
+        ttl = self.valves.cache_ttl
+        # 没有对外访问前缀时镜像URL无法访问，保持使用原始链接
+        if self.valves.mirror_dir and self.valves.mirror_url_prefix.strip():
+            mirror_url = await self.mirror_image(key, images[0].get("url", ""))
+            if mirror_url:
+                images[0]["url"] = mirror_url
+                ttl = self.valves.mirror_cache_ttl
+        self.set_cached_image(key, result, ttl)
         return result
 
+    def expand_batch(self, ai_outputs: List[AIOutput]) -> List[AIOutput]:
+        """将提示词列表和batch_size展开为逐张图片的生成任务，固定种子时依次递增"""
+        jobs = []
+        for ai_output in ai_outputs:
+            for n in range(max(1, ai_output.batch_size)):
+                seed = ai_output.seed if ai_output.seed == -1 else ai_output.seed + n
+                jobs.append(ai_output.model_copy(update={"seed": seed, "batch_size": 1}))
+        return jobs[: max(1, self.valves.max_batch_size)]
+
+    async def generate_image_url(
+        self,
+        ai_output: AIOutput,
+        semaphore: asyncio.Semaphore,
+        __user__: Optional[dict] = None,
+    ) -> str:
+        async with semaphore:
+            response_data = await self.generate_single_image(ai_output, __user__)
+        images = (response_data or {}).get("images") or []
+        if not images:
+            raise Exception("Siliconflow API Error: No images found in response.")
+        return images[0].get("url", "")
+
+    def render_image(self, ai_output: AIOutput, image_url: str, index: int = 0) -> List[str]:
+        heading = f"### 生成信息 {index}" if index else "### 生成信息"
+        return [
+            heading,
+            f"**提示词 (Prompt):** {ai_output.prompt}",
+            f"**尺寸 (Size):** {ai_output.width}x{ai_output.height}",
+            f"**种子 (Seed):** {ai_output.seed}",
+            f"**模型名称 (Model):** {self.valves.model_name}",
+            "\n### 生成的图片",
+            f"![预览图]({image_url})",
+            f"[🖼️图片下载链接]({image_url})",
+        ]
+
+    def render_error(self, ai_output: AIOutput, error: Exception, index: int) -> List[str]:
+        return [
+            f"### 生成信息 {index}",
+            f"**提示词 (Prompt):** {ai_output.prompt}",
+            f"**种子 (Seed):** {ai_output.seed}",
+            f"❌ **生成失败:** {error}",
+        ]
+
+    def render_pending(self, ai_output: AIOutput, index: int) -> List[str]:
+        heading = f"### 生成信息 {index}" if index else "### 生成信息"
+        return [heading, f"**提示词 (Prompt):** {ai_output.prompt}", "⏳ 正在生成..."]
+
+    def render_results(self, jobs: List[AIOutput], results: List[Any]) -> str:
+        """渲染全部图片；results中None表示仍在生成，Exception表示失败，否则为图片URL"""
+        numbered = len(jobs) > 1
+        content_lines = []
+        for i, (job, result) in enumerate(zip(jobs, results)):
+            index = i + 1 if numbered else 0
+            if result is None:
+                content_lines += self.render_pending(job, index)
+            elif isinstance(result, Exception):
+                content_lines += self.render_error(job, result, index)
+            else:
+                content_lines += self.render_image(job, result, index)
+        return "\n\n".join(content_lines)
+
+    async def report_progress(
+        self,
+        __event_emitter__: Callable[[Any], Awaitable[None]],
+        results: List[Any],
+        started: float,
+    ):
+        """定时刷新状态，显示已完成数量与已用时间"""
+        while True:
+            await asyncio.sleep(max(0.5, self.valves.status_interval))
+            finished = sum(result is not None for result in results)
+            await __event_emitter__(
+                {
+                    "type": "status",
+                    "data": {
+                        "description": f"🚀正在火速生成图片中（{finished}/{len(results)}），已用时 {time.monotonic() - started:.0f} 秒...",
+                        "done": False,
+                    },
+                }
+            )
+
+    async def generate_batch(
+        self,
+        jobs: List[AIOutput],
+        __event_emitter__: Callable[[Any], Awaitable[None]],
+        __user__: Optional[dict] = None,
+        tasks: Optional[List[asyncio.Task]] = None,
+    ) -> List[Any]:
+        """并发生成图片；开启渐进显示时，每张图片完成后立即替换消息内容。
+        tasks为流式阶段已启动的生成任务，与jobs一一对应"""
+        semaphore = asyncio.Semaphore(max(1, self.valves.max_concurrency))
+        results: List[Any] = [None] * len(jobs)
+        emit_lock = asyncio.Lock()
+        progressive = self.valves.progressive_delivery
+
+        async def replace_content():
+            # 加锁保证各次替换按完成顺序送达
+            async with emit_lock:
+                await __event_emitter__(
+                    {
+                        "type": "replace",
+                        "data": {"content": self.render_results(jobs, results)},
+                    }
+                )
+
+        async def run(i: int, job: AIOutput):
+            try:
+                results[i] = await (
+                    tasks[i] if tasks else self.generate_image_url(job, semaphore, __user__)
+                )
+            except Exception as e:
+                results[i] = e
+            if progressive:
+                await replace_content()
+
+        if progressive:
+            await replace_content()
+        ticker = asyncio.create_task(
+            self.report_progress(__event_emitter__, results, time.monotonic())
+        )
+        try:
+            await asyncio.gather(*(run(i, job) for i, job in enumerate(jobs)))
+        finally:
+            ticker.cancel()
+        return results
+
     async def outlet(
         self,
         body: dict,
         __event_emitter__: Callable[[Any], Awaitable[None]],
         __user__: Optional[dict] = None,
         __model__: Optional[dict] = None,
+        __metadata__: Optional[dict] = None,
     ) -> dict:
         if "messages" in body and body["messages"] and __user__ and "id" in __user__:
             await __event_emitter__(
@@ -140,52 +626,98 @@ class Filter:
             messages = body["messages"]
             if messages:
                 ai_output_content = messages[-1].get("content", "")
-                match = self.JSON_REGEX.search(ai_output_content)
-                if not match:
-                    raise ValueError("未在消息内容中找到有效的AI输出JSON。")
-
-                ai_output_json_str = match.group()
-
-                try:
-                    ai_output = AIOutput.parse_raw(ai_output_json_str)
-                except Exception as e:
-                    raise ValueError(f"解析AI输出JSON时出错: {e}")
-
-                if ai_output.success:
-                    response_data = await self.generate_single_image(
-                        ai_output, __user__
-                    )
-                    if response_data and "images" in response_data:
-                        images = response_data.get("images", [])
-                        if images:
-                            image_url = images[0].get("url", "")
-
-                            # 更新content_lines并重新写入
-                            content_lines = [
-                                f"### 生成信息",
-                                f"**提示词 (Prompt):** {ai_output.prompt}",
-                                f"**尺寸 (Size):** {ai_output.width}x{ai_output.height}",
-                                f"**种子 (Seed):** {ai_output.seed}",
-                                f"**模型名称 (Model):** {self.valves.model_name}",
-                                "\n### 生成的图片",
-                                f"![预览图]({image_url})",
-                                f"[🖼️图片下载链接]({image_url})",
-                            ]
-                            body["messages"][-1]["content"] = "\n\n".join(content_lines)
-
-                            await __event_emitter__(
-                                {
-                                    "type": "status",
-                                    "data": {
-                                        "description": "🎉图片生成成功！",
-                                        "done": True,
-                                    },
-                                }
-                            )
-                        else:
-                            raise Exception(
-                                "Siliconflow API Error: No images found in response."
-                            )
+                # 流式阶段已开始生成时直接复用，否则扫描完整回复
+                early = self._early_generations.pop(
+                    self.generation_key(body, __metadata__), None
+                )
+                if early and early.jobs:
+                    jobs, tasks = early.jobs, early.tasks
                 else:
-                    raise Exception(f"AI Output Error: {ai_output.reason}")
-        return body
\ No newline at end of file
+                    objects = JSONObjectScanner().feed(ai_output_content)
+                    if not objects:
+                        raise ValueError("未在消息内容中找到有效的AI输出JSON。")
+
+                    ai_outputs, parse_error = parse_ai_outputs(objects)
+                    if not ai_outputs:
+                        raise ValueError(f"解析AI输出JSON时出错: {parse_error}")
+
+                    jobs = self.expand_batch([o for o in ai_outputs if o.success])
+                    if not jobs:
+                        raise Exception(f"AI Output Error: {ai_outputs[0].reason}")
+                    tasks = None
+
+                results = await self.generate_batch(
+                    jobs, __event_emitter__, __user__, tasks
+                )
+                errors = [r for r in results if isinstance(r, Exception)]
+                if len(errors) == len(results):
+                    raise errors[0]
+
+                body["messages"][-1]["content"] = self.render_results(jobs, results)
+
+                await __event_emitter__(
+                    {
+                        "type": "status",
+                        "data": {
+                            "description": (
+                                f"⚠️图片生成完成，{len(results) - len(errors)}/{len(results)}张成功"
+                                if errors
+                                else "🎉图片生成成功！"
+                            ),
+                            "done": True,
+                        },
+                    }
+                )
+        return body
+
+
+def benchmark_inlet(messages: int = 500, turns: int = 20):
+    """python silicon_flow_drawing.py：在messages条历史上测量inlet每轮耗时，
+    历史每轮都从JSON重新解析，与Open WebUI重发历史的方式一致"""
+
+    async def emitter(event):
+        pass
+
+    def make_history(unclosed: bool) -> List[dict]:
+        history = []
+        for i in range(messages):
+            if i % 2:
+                text = f"第{i}张图：![image](https://example.com/{i}.png)\n" * 5 + "说明文字" * 50
+                if unclosed:
+                    text += "![" * 500
+                history.append({"role": "assistant", "content": text})
+            elif i % 10 == 0:
+                history.append(
+                    {
+                        "role": "user",
+                        "content": [
+                            {"type": "text", "text": f"画一只猫 ![ref](https://example.com/{i}.png)"},
+                            {"type": "image_url", "image_url": {"url": "data:image/png;base64,AA"}},
+                        ],
+                    }
+                )
+            else:
+                history.append({"role": "user", "content": f"画一只猫，编号{i}"})
+        return history
+
+    async def run():
+        for name, unclosed in (("image-heavy", False), ("unclosed '![' runs", True)):
+            payload = json.dumps(make_history(unclosed))
+            f = Filter()
+            times = []
+            for _ in range(turns):
+                body = {"messages": json.loads(payload)}
+                start = time.perf_counter()
+                await f.inlet(body, emitter)
+                times.append(time.perf_counter() - start)
+            later = sorted(times[1:])
+            print(
+                f"{name}: first turn {times[0] * 1e3:.2f}ms, "
+                f"later turns p50 {later[len(later) // 2] * 1e3:.2f}ms"
+            )
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    benchmark_inlet()
@@ -1,6 +1,6 @@
 """
 title: Enhanced Web Scrape
-description: An improved web scraping tool that extracts text content using Jina Reader, now with better filtering, user-configuration, and UI feedback using emitters.
+description: An improved web scraping tool that extracts text content using Jina Reader or a local HTML-to-markdown extractor, now with better filtering, user-configuration, and UI feedback using emitters.
 author: ekatiyar
 author_url: https://github.com/ekatiyar
 github: https://github.com/ekatiyar/open-webui-tools
@@ -8,16 +8,31 @@ original_author: Pyotr Growpotkin
 original_author_url: https://github.com/christ-offer/
 original_github: https://github.com/christ-offer/open-webui-tools
 funding_url: https://github.com/open-webui
-version: 0.0.4
+version: 0.0.6
 license: MIT
 """
 
+import asyncio
+import ipaddress
+import multiprocessing
+import numpy as np
+import socket
+import pickle
 import requests
-from typing import Callable, Any
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from html.parser import HTMLParser
+from typing import Callable, Any, Optional
+from urllib.parse import urljoin, urlparse
 import re
 from pydantic import BaseModel, Field
 
+import sys
+import time
+import types
 import unittest
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 
 def extract_title(text):
@@ -41,6 +56,362 @@ def clean_urls(text) -> str:
     return re.sub(r"\((http[^)]+)\)", "", text)
 
 
+def tokenize(text: str) -> list:
+    """
+    Splits text into lowercase terms for lexical ranking. Latin words are kept
+    whole; CJK runs are split into character unigrams and bigrams.
+
+    :param text: The input string.
+    :return: The list of terms.
+    """
+    terms = []
+    for word in re.findall(r"[a-z0-9]+|[\u3040-\u30ff\u4e00-\u9fff]+", text.lower()):
+        if word[0].isascii():
+            terms.append(word)
+        else:
+            terms.extend(word)
+            terms.extend(word[i : i + 2] for i in range(len(word) - 1))
+    return terms
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Roughly estimates the LLM token count of a string: about four characters per
+    token for latin text and one token per CJK character.
+    """
+    cjk = len(re.findall(r"[\u3040-\u30ff\u4e00-\u9fff]", text))
+    return cjk + (len(text) - cjk) // 4 + 1
+
+
+def split_long(text: str, max_chars: int) -> list:
+    """
+    Breaks text longer than `max_chars` at sentence ends, cutting sentences that
+    are still too long into fixed windows.
+    """
+    if len(text) <= max_chars:
+        return [text]
+    pieces, current = [], ""
+    for sentence in re.split(r"(?<=[.!?;。！？；])", text):
+        while len(sentence) > max_chars:
+            if current:
+                pieces.append(current)
+                current = ""
+            pieces.append(sentence[:max_chars])
+            sentence = sentence[max_chars:]
+        if current and len(current) + len(sentence) > max_chars:
+            pieces.append(current)
+            current = ""
+        current += sentence
+    if current.strip():
+        pieces.append(current)
+    return pieces
+
+
+def split_sections(markdown: str, max_chars: int = 2000) -> list:
+    """
+    Splits markdown into sections at headings, breaking oversized sections at
+    paragraph boundaries and oversized paragraphs at sentence boundaries.
+
+    :param markdown: The markdown content.
+    :param max_chars: The soft maximum length of a section.
+    :return: The list of non-empty sections in document order.
+    """
+    sections = []
+    for block in re.split(r"\n(?=#{1,6} )", markdown):
+        current = ""
+        for paragraph in block.split("\n\n"):
+            for piece in split_long(paragraph, max_chars):
+                if current and len(current) + len(piece) > max_chars:
+                    sections.append(current.strip())
+                    current = ""
+                current += piece + "\n\n"
+        if current.strip():
+            sections.append(current.strip())
+    return sections
+
+
+def rank_sections(
+    sections: list, query: str, k1: float = 1.5, b: float = 0.75
+) -> np.ndarray:
+    """
+    Scores sections against a query with Okapi BM25.
+
+    :param sections: The sections to score.
+    :param query: The search query.
+    :return: An array with one score per section.
+    """
+    query_terms = list(dict.fromkeys(tokenize(query)))
+    if not sections or not query_terms:
+        return np.zeros(len(sections))
+
+    column = {term: i for i, term in enumerate(query_terms)}
+    tf = np.zeros((len(sections), len(query_terms)))
+    lengths = np.zeros(len(sections))
+    for row, section in enumerate(sections):
+        terms = tokenize(section)
+        lengths[row] = len(terms)
+        for term in terms:
+            i = column.get(term)
+            if i is not None:
+                tf[row, i] += 1
+
+    df = np.count_nonzero(tf, axis=0)
+    idf = np.log((len(sections) - df + 0.5) / (df + 0.5) + 1.0)
+    norm = k1 * (1 - b + b * lengths / max(lengths.mean(), 1.0))
+    return (tf * (k1 + 1) / (tf + norm[:, None]) * idf).sum(axis=1)
+
+
+def truncate_around(text: str, query: str, token_budget: int) -> str:
+    """
+    Cuts text down to the token budget, keeping a window that starts shortly
+    before the first occurrence of a query term.
+    """
+    lowered = text.lower()
+    hits = [lowered.find(term) for term in tokenize(query)]
+    hits = [hit for hit in hits if hit >= 0]
+    window = text
+    size = len(text)
+    while estimate_tokens(window) > token_budget:
+        size = int(size * token_budget / estimate_tokens(window) * 0.95)
+        start = max(0, min(min(hits, default=0) - size // 4, len(text) - size))
+        window = text[start : start + size]
+    return window
+
+
+def select_relevant(content: str, query: str, top_k: int, token_budget: int) -> str:
+    """
+    Keeps only the sections of scraped content most relevant to a query.
+
+    :param content: The scraped content, optionally with a Jina-style header.
+    :param query: The search query.
+    :param top_k: The maximum number of sections to keep.
+    :param token_budget: The maximum estimated tokens of the kept sections.
+    :return: The header followed by the selected sections in document order.
+    """
+    header, marker, body = content.partition("Markdown Content:\n")
+    if not marker:
+        header, body = "", content
+    sections = split_sections(body)
+    scores = rank_sections(sections, query)
+
+    # Rank by score; when nothing matches, fall back to the leading sections
+    order = np.argsort(-scores, kind="stable") if scores.any() else range(len(sections))
+    selected, used = [], 0
+    for i in order:
+        if len(selected) >= top_k or (scores.any() and scores[i] <= 0):
+            break
+        cost = estimate_tokens(sections[i])
+        if used + cost > token_budget:
+            continue
+        selected.append(i)
+        used += cost
+
+    kept = "\n\n".join(sections[i] for i in sorted(selected))
+    if not selected and len(order):
+        # Nothing fits the budget whole: truncate the best section rather than
+        # return an empty page
+        best = order[0]
+        kept = truncate_around(sections[best], query, token_budget)
+        selected = [best]
+    note = f"({len(selected)} of {len(sections)} sections most relevant to: {query})\n\n"
+    return header + marker + note + kept
+
+
+class MarkdownExtractor(HTMLParser):
+    """
+    Streaming HTML to markdown converter. Feed it chunks of HTML and call
+    `markdown()` once done; only the current tag stack is kept in memory.
+    """
+
+    SKIP_TAGS = {"script", "style", "noscript", "template", "svg", "iframe", "canvas"}
+    BLOCK_TAGS = {
+        "p", "div", "section", "article", "main", "header", "footer", "aside",
+        "ul", "ol", "table", "tr", "form", "figure", "figcaption", "dl", "dt", "dd",
+    }
+
+    def __init__(self, base_url: str = ""):
+        super().__init__(convert_charrefs=True)
+        self.base_url = base_url
+        self.title = ""
+        self.parts = []
+        self.skip_depth = 0
+        self.pre_depth = 0
+        self.in_title = False
+        self.links = []
+
+    def _newline(self, count=1):
+        self.parts.append("\n" * count)
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self.skip_depth += 1
+            return
+        if self.skip_depth:
+            return
+        attrs = dict(attrs)
+        if tag == "title":
+            self.in_title = True
+        elif tag in ("h1", "h2", "h3", "h4", "h5", "h6"):
+            self._newline(2)
+            self.parts.append("#" * int(tag[1]) + " ")
+        elif tag in self.BLOCK_TAGS:
+            self._newline(2)
+        elif tag == "li":
+            self._newline()
+            self.parts.append("- ")
+        elif tag in ("td", "th"):
+            self.parts.append(" | ")
+        elif tag == "br":
+            self._newline()
+        elif tag == "hr":
+            self.parts.append("\n\n---\n\n")
+        elif tag == "blockquote":
+            self._newline(2)
+            self.parts.append("> ")
+        elif tag == "pre":
+            self.pre_depth += 1
+            self.parts.append("\n\n```\n")
+        elif tag == "code" and not self.pre_depth:
+            self.parts.append("`")
+        elif tag in ("strong", "b"):
+            self.parts.append("**")
+        elif tag in ("em", "i"):
+            self.parts.append("*")
+        elif tag == "a":
+            self.links.append(attrs.get("href"))
+            self.parts.append("[")
+        elif tag == "img":
+            src = attrs.get("src")
+            if src:
+                alt = (attrs.get("alt") or "").strip()
+                self.parts.append(f"![{alt}]({urljoin(self.base_url, src)})")
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS:
+            self.skip_depth = max(0, self.skip_depth - 1)
+            return
+        if self.skip_depth:
+            return
+        if tag == "title":
+            self.in_title = False
+        elif tag in ("h1", "h2", "h3", "h4", "h5", "h6") or tag in self.BLOCK_TAGS:
+            self._newline(2)
+        elif tag == "blockquote":
+            self._newline(2)
+        elif tag == "pre":
+            self.pre_depth = max(0, self.pre_depth - 1)
+            self.parts.append("\n```\n\n")
+        elif tag == "code" and not self.pre_depth:
+            self.parts.append("`")
+        elif tag in ("strong", "b"):
+            self.parts.append("**")
+        elif tag in ("em", "i"):
+            self.parts.append("*")
+        elif tag == "a" and self.links:
+            href = self.links.pop()
+            if href and not href.startswith(("#", "javascript:")):
+                self.parts.append(f"]({urljoin(self.base_url, href)})")
+            else:
+                self.parts.append("]")
+
+    def handle_data(self, data):
+        if self.skip_depth:
+            return
+        if self.in_title:
+            self.title += data.strip()
+            return
+        if self.pre_depth:
+            self.parts.append(data)
+        else:
+            self.parts.append(re.sub(r"\s+", " ", data))
+
+    def markdown(self) -> str:
+        # Odd segments are the contents of ``` fences and keep their whitespace
+        segments = "".join(self.parts).split("```")
+        for i in range(0, len(segments), 2):
+            text = re.sub(r"(?<!!)\[\s*\]\([^)]*\)", "", segments[i])
+            text = re.sub(r"[ \t]+\n", "\n", text)
+            text = re.sub(r"\n[ \t]+", "\n", text)
+            segments[i] = re.sub(r"\n{3,}", "\n\n", text)
+        return "```".join(segments).strip()
+
+
+def html_to_markdown(html: str, url: str = "") -> str:
+    """
+    Converts an HTML document to markdown in the same layout Jina Reader returns.
+
+    :param html: The raw HTML document.
+    :param url: The URL the document was fetched from, used to resolve relative links.
+    :return: The page as `Title: ...`, `URL Source: ...` and `Markdown Content:` sections.
+    """
+    parser = MarkdownExtractor(url)
+    # Feed in slices so the parser never holds more than one chunk of raw input
+    for start in range(0, len(html), 65536):
+        parser.feed(html[start : start + 65536])
+    parser.close()
+    return f"Title: {parser.title}\n\nURL Source: {url}\n\nMarkdown Content:\n{parser.markdown()}"
+
+
+_parser_pool: Optional[ProcessPoolExecutor] = None
+# Set once the pool fails to pickle the parser, so later calls go straight to a thread
+_parser_pool_disabled = False
+
+
+def parser_importable() -> bool:
+    """
+    Whether worker processes can load `html_to_markdown` by its module name.
+    Open WebUI loads tools with `exec` into a module it then drops from
+    `sys.modules`, so there the pool is never started.
+    """
+    module = sys.modules.get(html_to_markdown.__module__)
+    return (
+        getattr(module, "__spec__", None) is not None
+        and getattr(module, "html_to_markdown", None) is html_to_markdown
+    )
+
+
+def get_parser_pool(max_workers: int) -> ProcessPoolExecutor:
+    """
+    Returns the shared process pool used for local HTML parsing, creating it on first use.
+    Workers are spawned rather than forked from the (multithreaded) server process.
+    """
+    global _parser_pool
+    if _parser_pool is None:
+        _parser_pool = ProcessPoolExecutor(
+            max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _parser_pool
+
+
+def discard_parser_pool():
+    """
+    Drops a broken parser pool so the next call starts a fresh one.
+    """
+    global _parser_pool
+    if _parser_pool is not None:
+        _parser_pool.shutdown(wait=False, cancel_futures=True)
+        _parser_pool = None
+
+
+async def convert_html(html: str, url: str, max_workers: int) -> str:
+    """
+    Runs `html_to_markdown` in the parser process pool when the workers can load
+    it, and in a thread otherwise (exec-loaded tool, pool disabled or failed).
+    """
+    global _parser_pool_disabled
+    if max_workers > 0 and not _parser_pool_disabled and parser_importable():
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                get_parser_pool(max_workers), html_to_markdown, html, url
+            )
+        except BrokenProcessPool:
+            discard_parser_pool()
+        except (pickle.PicklingError, AttributeError, TypeError):
+            _parser_pool_disabled = True
+            discard_parser_pool()
+    return await asyncio.to_thread(html_to_markdown, html, url)
+
+
 class EventEmitter:
     def __init__(self, event_emitter: Callable[[dict], Any] = None):
         self.event_emitter = event_emitter
@@ -68,6 +439,10 @@ class EventEmitter:
             )
 
 
+# Redirect hops the local backend follows, each one re-checked by Tools.check_url
+MAX_REDIRECTS = 10
+
+
 class Tools:
     class Valves(BaseModel):
         DISABLE_CACHING: bool = Field(
@@ -77,6 +452,33 @@ class Tools:
             default="",
             description="(Optional) Jina API key. Allows a higher rate limit when scraping. Used when a User-specific API key is not available.",
         )
+        SCRAPE_BACKEND: str = Field(
+            default="jina",
+            description="Extraction backend: 'jina' (r.jina.ai), 'local' (fetch and convert in-process) or 'auto' (local first, falling back to Jina).",
+        )
+        LOCAL_PARSER_WORKERS: int = Field(
+            default=2,
+            description="Number of worker processes used to convert HTML to markdown with the local backend, 0 to parse in a thread. Tools loaded by Open WebUI always parse in a thread, since worker processes cannot import them.",
+        )
+        LOCAL_ALLOW_PRIVATE_ADDRESSES: bool = Field(
+            default=False,
+            description="Let the local backend fetch loopback, private and link-local addresses. Pages are fetched from the Open WebUI host, so only enable this when the model may read internal services.",
+        )
+        LOCAL_MIN_CONTENT_LENGTH: int = Field(
+            default=200,
+            description="In 'auto' mode, fall back to Jina when the local backend extracts fewer characters than this (e.g. JavaScript-rendered pages).",
+        )
+        REQUEST_TIMEOUT: int = Field(
+            default=30, description="Timeout in seconds for scrape requests."
+        )
+        RELEVANT_TOP_K: int = Field(
+            default=5,
+            description="When a query is given, the maximum number of page sections returned.",
+        )
+        RELEVANT_TOKEN_BUDGET: int = Field(
+            default=2000,
+            description="When a query is given, the approximate token budget for the returned sections.",
+        )
 
     class UserValves(BaseModel):
         CLEAN_CONTENT: bool = Field(
@@ -92,41 +494,138 @@ class Tools:
         self.valves = self.Valves()
         self.citation = True
 
+    def scrape_jina(self, url: str, __user__: dict = {}) -> str:
+        """
+        Fetches the page through r.jina.ai, which returns it already converted to markdown.
+        """
+        jina_url = f"https://r.jina.ai/{url}"
+
+        headers = {
+            "X-No-Cache": "true" if self.valves.DISABLE_CACHING else "false",
+            "X-With-Generated-Alt": "true",
+        }
+
+        if "valves" in __user__ and __user__["valves"].JINA_API_KEY:
+            headers["Authorization"] = f"Bearer {__user__['valves'].JINA_API_KEY}"
+        elif self.valves.GLOBAL_JINA_API_KEY:
+            headers["Authorization"] = f"Bearer {self.valves.GLOBAL_JINA_API_KEY}"
+
+        response = requests.get(
+            jina_url, headers=headers, timeout=self.valves.REQUEST_TIMEOUT
+        )
+        response.raise_for_status()
+        return response.text
+
+    def check_url(self, url: str):
+        """
+        Rejects URLs the local backend must not fetch from the Open WebUI host:
+        anything but http(s), and hosts resolving to loopback, private, link-local
+        or other non-public addresses (e.g. cloud metadata at 169.254.169.254).
+        """
+        parsed = urlparse(url)
+        if parsed.scheme not in ("http", "https") or not parsed.hostname:
+            raise ValueError(f"Unsupported URL: {url}")
+        if self.valves.LOCAL_ALLOW_PRIVATE_ADDRESSES:
+            return
+        for info in socket.getaddrinfo(
+            parsed.hostname, parsed.port, proto=socket.IPPROTO_TCP
+        ):
+            address = ipaddress.ip_address(info[4][0].split("%")[0])
+            if not address.is_global:
+                raise ValueError(
+                    f"Refusing to fetch {url}: {parsed.hostname} resolves to non-public address {address}"
+                )
+
+    def fetch_local(self, url: str) -> tuple:
+        """
+        Fetches the page and decodes it, following redirects by hand so every hop
+        passes `check_url`. Blocking, so it runs in a thread.
+
+        :return: The page text, the final URL and its Content-Type.
+        """
+        for _ in range(MAX_REDIRECTS + 1):
+            self.check_url(url)
+            response = requests.get(
+                url,
+                headers={"User-Agent": "Mozilla/5.0 (compatible; OpenWebUI-WebScrape)"},
+                timeout=self.valves.REQUEST_TIMEOUT,
+                allow_redirects=False,
+            )
+            if not response.is_redirect:
+                break
+            response.close()
+            url = urljoin(url, response.headers["Location"])
+        else:
+            raise ValueError(f"Too many redirects fetching {url}")
+        response.raise_for_status()
+
+        content_type = response.headers.get("Content-Type", "")
+        if "html" in content_type and "charset" not in content_type:
+            # Charset detection is CPU-bound, keep it in this thread too
+            response.encoding = response.apparent_encoding
+        return response.text, response.url, content_type
+
+    async def scrape_local(self, url: str) -> str:
+        """
+        Fetches the page directly and converts it to markdown in the parser process pool.
+        """
+        # requests blocks, so fetch in a thread to keep the event loop responsive
+        text, final_url, content_type = await asyncio.to_thread(self.fetch_local, url)
+        if "html" not in content_type:
+            return text
+
+        return await convert_html(text, final_url, self.valves.LOCAL_PARSER_WORKERS)
+
     async def web_scrape(
         self,
         url: str,
+        query: str = "",
         __event_emitter__: Callable[[dict], Any] = None,
         __user__: dict = {},
     ) -> str:
         """
-        Scrape and process a web page using r.jina.ai
+        Scrape and process a web page using r.jina.ai or the local extractor
 
         :param url: The URL of the web page to scrape.
+        :param query: (Optional) What to look for on the page. When given, only the most relevant parts of the page are returned.
         :return: The scraped and processed webpage content, or an error message.
         """
         emitter = EventEmitter(__event_emitter__)
 
         await emitter.progress_update(f"Scraping {url}")
-        jina_url = f"https://r.jina.ai/{url}"
-
-        headers = {
-            "X-No-Cache": "true" if self.valves.DISABLE_CACHING else "false",
-            "X-With-Generated-Alt": "true",
-        }
-
-        if "valves" in __user__ and __user__["valves"].JINA_API_KEY:
-            headers["Authorization"] = f"Bearer {__user__['valves'].JINA_API_KEY}"
-        elif self.valves.GLOBAL_JINA_API_KEY:
-            headers["Authorization"] = f"Bearer {self.valves.GLOBAL_JINA_API_KEY}"
+        backend = self.valves.SCRAPE_BACKEND.lower()
 
         try:
-            response = requests.get(jina_url, headers=headers)
-            response.raise_for_status()
+            if backend == "jina":
+                text = await asyncio.to_thread(self.scrape_jina, url, __user__)
+            elif backend == "local":
+                text = await self.scrape_local(url)
+            else:
+                try:
+                    text = await self.scrape_local(url)
+                    body = text.split("Markdown Content:\n", 1)[-1]
+                    if len(body) < self.valves.LOCAL_MIN_CONTENT_LENGTH:
+                        raise ValueError("Extracted content too short")
+                except Exception:
+                    # Any local failure (network, parsing, worker pool) falls back to Jina
+                    await emitter.progress_update(
+                        f"Local extraction failed, scraping {url} with Jina ..."
+                    )
+                    text = await asyncio.to_thread(self.scrape_jina, url, __user__)
 
             should_clean = "valves" not in __user__ or __user__["valves"].CLEAN_CONTENT
             if should_clean:
                 await emitter.progress_update("Received content, cleaning up ...")
-            content = clean_urls(response.text) if should_clean else response.text
+            content = clean_urls(text) if should_clean else text
+
+            if query:
+                await emitter.progress_update(f"Selecting content relevant to: {query}")
+                content = select_relevant(
+                    content,
+                    query,
+                    self.valves.RELEVANT_TOP_K,
+                    self.valves.RELEVANT_TOKEN_BUDGET,
+                )
 
             title = extract_title(content)
             await emitter.success_update(
@@ -134,7 +633,7 @@ class Tools:
             )
             return content
 
-        except requests.RequestException as e:
+        except Exception as e:
             error_message = f"Error scraping web page: {str(e)}"
             await emitter.error_update(error_message)
             return error_message
@@ -148,6 +647,230 @@ class WebScrapeTest(unittest.IsolatedAsyncioTestCase):
         self.assertEqual(len(content), 770)
 
 
+TEST_PAGES = {
+    "/article.html": """<!DOCTYPE html>
+<html><head><title>Local Fixture</title><style>body { color: red; }</style></head>
+<body>
+<script>var ignored = "<p>not content</p>";</script>
+<h1>Main Heading</h1>
+<p>First paragraph with a <a href="/next.html">relative link</a> and <strong>bold</strong> text.</p>
+<ul><li>One</li><li>Two</li></ul>
+<img src="/logo.png" alt="Logo">
+<pre>line 1
+  line 2</pre>
+</body></html>""",
+    "/empty.html": "<html><head><title>Empty</title></head><body><div id='app'></div></body></html>",
+}
+
+
+class SelectRelevantTest(unittest.TestCase):
+    def test_select_relevant(self):
+        filler = "Unrelated filler sentence about nothing in particular. " * 20
+        body = "\n\n".join(
+            [
+                f"# Intro\n\n{filler}",
+                "## Pricing\n\nThe basic plan costs 10 dollars per month.",
+                f"## History\n\n{filler}",
+                "## 价格\n\n高级套餐每月价格为二十美元。",
+                f"## Footer\n\n{filler}",
+            ]
+        )
+        content = f"Title: Plans\n\nURL Source: http://example.com\n\nMarkdown Content:\n{body}"
+        selected = select_relevant(content, "pricing plan cost", 1, 2000)
+        self.assertEqual("Plans", extract_title(selected))
+        self.assertIn("10 dollars", selected)
+        self.assertNotIn("filler", selected)
+
+        selected = select_relevant(content, "价格", 5, 2000)
+        self.assertIn("二十美元", selected)
+        self.assertNotIn("10 dollars", selected)
+
+    def test_select_relevant_token_budget(self):
+        sections = [f"## Part {i}\n\n" + "apple banana " * 100 for i in range(10)]
+        selected = select_relevant("\n\n".join(sections), "apple", 10, 1000)
+        self.assertLessEqual(estimate_tokens(selected), 1100)
+        self.assertIn("## Part", selected)
+
+
+    def test_select_relevant_long_paragraph(self):
+        paragraph = "这是一段很长的介绍文字，没有任何标题和空行。" * 300 + "本产品的价格为每月二十美元。" + "结尾的补充说明。" * 300
+        selected = select_relevant(paragraph, "价格", 5, 500)
+        self.assertIn("二十美元", selected)
+        self.assertLessEqual(estimate_tokens(selected), 600)
+
+        unbroken = "价格" + "字" * 5000
+        selected = select_relevant(unbroken, "价格", 5, 500)
+        self.assertIn("价格", selected)
+        self.assertLessEqual(estimate_tokens(selected), 600)
+
+TEST_REDIRECTS = {
+    "/moved.html": "/article.html",
+    "/metadata.html": "http://169.254.169.254/latest/meta-data/",
+}
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/slow.html":
+            time.sleep(0.3)
+            self.path = "/article.html"
+        if self.path in TEST_REDIRECTS:
+            self.send_response(302)
+            self.send_header("Location", TEST_REDIRECTS[self.path])
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        page = TEST_PAGES.get(self.path)
+        if page is None:
+            self.send_error(404)
+            return
+        data = page.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LocalScrapeTest(unittest.IsolatedAsyncioTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), FixtureHandler)
+        cls.base_url = f"http://127.0.0.1:{cls.server.server_address[1]}"
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def make_tools(self, backend="local"):
+        tools = Tools()
+        tools.valves.SCRAPE_BACKEND = backend
+        # The fixture server listens on loopback
+        tools.valves.LOCAL_ALLOW_PRIVATE_ADDRESSES = True
+        return tools
+
+    async def test_local_backend(self):
+        url = f"{self.base_url}/article.html"
+        content = await self.make_tools().web_scrape(url, __user__={})
+        self.assertEqual("Local Fixture", extract_title(content))
+        self.assertIn("# Main Heading", content)
+        self.assertIn("[relative link]", content)
+        self.assertIn("**bold**", content)
+        self.assertIn("- One\n- Two", content)
+        self.assertIn("![Logo]", content)
+        self.assertIn("line 1\n  line 2", content)
+        self.assertNotIn("not content", content)
+        self.assertNotIn("color: red", content)
+        self.assertNotIn("http", content.split("Markdown Content:")[1])
+
+    async def test_local_backend_keeps_urls(self):
+        url = f"{self.base_url}/article.html"
+        content = await self.make_tools().scrape_local(url)
+        self.assertIn(f"[relative link]({self.base_url}/next.html)", content)
+        self.assertIn(f"![Logo]({self.base_url}/logo.png)", content)
+
+    async def test_local_backend_http_error(self):
+        url = f"{self.base_url}/missing.html"
+        content = await self.make_tools().web_scrape(url, __user__={})
+        self.assertTrue(content.startswith("Error scraping web page"))
+
+    async def test_auto_backend_falls_back_to_jina(self):
+        tools = self.make_tools("auto")
+        tools.valves.LOCAL_MIN_CONTENT_LENGTH = 50
+        tools.scrape_jina = lambda url, __user__={}: f"Title: From Jina\n\nURL Source: {url}\n"
+        article = await tools.web_scrape(f"{self.base_url}/article.html", __user__={})
+        self.assertEqual("Local Fixture", extract_title(article))
+        empty = await tools.web_scrape(f"{self.base_url}/empty.html", __user__={})
+        self.assertEqual("From Jina", extract_title(empty))
+
+    async def test_local_backend_exec_loaded(self):
+        # Load the tool the way Open WebUI does: exec into a module that is not
+        # importable by name, so worker processes cannot unpickle the parser
+        with open(__file__, encoding="utf-8") as f:
+            source = f.read()
+        module = types.ModuleType("tool_web_scrape_exec")
+        sys.modules[module.__name__] = module
+        try:
+            exec(compile(source, __file__, "exec"), module.__dict__)
+        finally:
+            del sys.modules[module.__name__]
+        tools = module.Tools()
+        tools.valves.SCRAPE_BACKEND = "local"
+        tools.valves.LOCAL_ALLOW_PRIVATE_ADDRESSES = True
+        content = await tools.web_scrape(f"{self.base_url}/article.html", __user__={})
+        self.assertEqual("Local Fixture", extract_title(content))
+        self.assertIn("# Main Heading", content)
+        # Parsed in a thread without ever starting worker processes
+        self.assertIsNone(module._parser_pool)
+
+    async def test_parser_pool_when_importable(self):
+        if not parser_importable():
+            self.skipTest("module is not importable by name (run as a script)")
+        html = TEST_PAGES["/article.html"]
+        markdown = await convert_html(html, self.base_url, 1)
+        self.assertEqual(html_to_markdown(html, self.base_url), markdown)
+        self.assertIsNotNone(_parser_pool)
+
+    async def test_local_backend_follows_redirects(self):
+        content = await self.make_tools().scrape_local(f"{self.base_url}/moved.html")
+        self.assertEqual("Local Fixture", extract_title(content))
+        self.assertIn(f"URL Source: {self.base_url}/article.html", content)
+
+    async def test_local_backend_rejects_private_addresses(self):
+        tools = Tools()
+        tools.valves.SCRAPE_BACKEND = "local"
+        content = await tools.web_scrape(f"{self.base_url}/article.html", __user__={})
+        self.assertTrue(content.startswith("Error scraping web page"))
+        self.assertIn("non-public address 127.0.0.1", content)
+        for url in ("http://169.254.169.254/latest/meta-data/", "file:///etc/passwd"):
+            with self.assertRaises(ValueError):
+                tools.check_url(url)
+
+    async def test_local_backend_rejects_private_redirect(self):
+        tools = Tools()
+        tools.valves.SCRAPE_BACKEND = "local"
+        # Trust the fixture server itself, but not where it redirects to
+        tools.check_url = lambda url: (
+            None if url.startswith(self.base_url) else Tools.check_url(tools, url)
+        )
+        content = await tools.web_scrape(f"{self.base_url}/metadata.html", __user__={})
+        self.assertTrue(content.startswith("Error scraping web page"))
+        self.assertIn("169.254.169.254", content)
+
+    async def test_local_backend_does_not_block_loop(self):
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        task = asyncio.create_task(ticker())
+        try:
+            await self.make_tools().web_scrape(f"{self.base_url}/slow.html", __user__={})
+        finally:
+            task.cancel()
+        self.assertGreater(ticks, 10)
+
+    def test_html_to_markdown_split_tags(self):
+        html = TEST_PAGES["/article.html"]
+        parser = MarkdownExtractor("http://example.com")
+        for i in range(0, len(html), 7):
+            parser.feed(html[i : i + 7])
+        parser.close()
+        self.assertEqual(parser.title, "Local Fixture")
+        self.assertEqual(
+            parser.markdown(),
+            html_to_markdown(html, "http://example.com").split("Markdown Content:\n")[1],
+        )
+
+
 if __name__ == "__main__":
     print("Running tests...")
     unittest.main()
@@ -1,6 +1,14 @@
 from pydantic import BaseModel
 from typing import Optional, Dict, List, Any
 from datetime import datetime, timezone, timedelta
+import json
+import unittest
+
+# 北京时间（UTC+8）
+BEIJING_TZ = timezone(timedelta(hours=8))
+TIME_PREFIX = "[时间: "
+INPUTS_SUFFIX = "</inputs>"
+
 
 class Filter:
     # 可选的配置选项
@@ -11,19 +19,45 @@ class Filter:
         # 初始化配置
         self.valves = self.Valves()
 
+    @staticmethod
+    def is_wrapped(text: str) -> bool:
+        # 只比较首尾，无需扫描整段内容
+        return text.startswith(TIME_PREFIX) and text.endswith(INPUTS_SUFFIX)
+
+    @staticmethod
+    def format_time(message: dict) -> str:
+        # 优先使用Open WebUI提供的消息创建时间（秒或毫秒时间戳），否则使用当前时间
+        timestamp = message.get("timestamp") or message.get("created_at")
+        if isinstance(timestamp, (int, float)) and timestamp > 0:
+            if timestamp > 1e12:
+                timestamp /= 1000
+            created = datetime.fromtimestamp(timestamp, timezone.utc)
+        else:
+            created = datetime.now(timezone.utc)
+        return created.astimezone(BEIJING_TZ).strftime("%Y-%m-%d %H:%M:%S")
+
+    def wrap(self, text: str, message: dict) -> str:
+        if self.is_wrapped(text):
+            return text
+        return f"{TIME_PREFIX}{self.format_time(message)}]\n<inputs>{text}{INPUTS_SUFFIX}"
+
     # 处理用户输入的函数
     def inlet(self, body: dict, __user__: Optional[dict] = None) -> dict:
-        # 遍历所有消息
-        for message in body.get("messages", []):
-            # 只处理用户角色的消息
-            if message.get("role") == "user":
-                # 获取当前UTC时间并转换为北京时间（UTC+8）
-                current_time = datetime.now(timezone.utc)
-                beijing_time = current_time.astimezone(timezone(timedelta(hours=8)))
-                formatted_time = beijing_time.strftime("%Y-%m-%d %H:%M:%S")
-                # 将用户消息添加时间戳并用<inputs>标签包裹
-                message["content"] = f"[时间: {formatted_time}]\n<inputs>{message['content']}</inputs>"
-        
+        # 只处理最新的一条用户消息，历史消息保持原样，避免每轮重复包裹导致提示词膨胀
+        for message in reversed(body.get("messages", [])):
+            if message.get("role") != "user":
+                continue
+            content = message.get("content")
+            if isinstance(content, str):
+                message["content"] = self.wrap(content, message)
+            elif isinstance(content, list):
+                # 多模态消息只包裹第一段文本
+                for part in content:
+                    if part.get("type") == "text" and isinstance(part.get("text"), str):
+                        part["text"] = self.wrap(part["text"], message)
+                        break
+            break
+
         return body
 
     # 处理流式输出的函数 (0.5.17新功能)
@@ -35,3 +69,54 @@ class Filter:
     def outlet(self, body: dict, __user__: Optional[dict] = None) -> dict:
         # 不修改模型的回复
         return body
+
+
+class WrapInputTagsTest(unittest.TestCase):
+    def test_history_payload_bounded(self):
+        # 模拟Open WebUI每轮把已过滤的历史原样重发，并把过滤结果存回历史
+        f = Filter()
+        history = []
+        sizes = []
+        for turn in range(200):
+            history.append({"role": "user", "content": f"问题{turn:03d}", "timestamp": 1700000000 + turn})
+            body = f.inlet({"messages": json.loads(json.dumps(history))})
+            history = body["messages"]
+            sizes.append(len(json.dumps(history, ensure_ascii=False)))
+            history.append({"role": "assistant", "content": f"回答{turn:03d}"})
+        growth = {b - a for a, b in zip(sizes, sizes[1:])}
+        self.assertEqual(1, len(growth))
+        for message in history:
+            if message["role"] == "user":
+                self.assertEqual(1, message["content"].count("<inputs>"))
+
+    def test_only_newest_message_wrapped(self):
+        body = {
+            "messages": [
+                {"role": "user", "content": "旧问题"},
+                {"role": "assistant", "content": "回答"},
+                {"role": "user", "content": "新问题", "timestamp": 1700000000000},
+            ]
+        }
+        Filter().inlet(body)
+        self.assertEqual("旧问题", body["messages"][0]["content"])
+        self.assertEqual(
+            "[时间: 2023-11-15 06:13:20]\n<inputs>新问题</inputs>",
+            body["messages"][2]["content"],
+        )
+
+    def test_multimodal_first_text_part(self):
+        content = [
+            {"type": "image_url", "image_url": {"url": "data:image/png;base64,AA"}},
+            {"type": "text", "text": "这是什么"},
+            {"type": "text", "text": "补充"},
+        ]
+        body = {"messages": [{"role": "user", "content": content, "timestamp": 1700000000}]}
+        Filter().inlet(body)
+        Filter().inlet(body)
+        self.assertEqual("[时间: 2023-11-15 06:13:20]\n<inputs>这是什么</inputs>", content[1]["text"])
+        self.assertEqual("补充", content[2]["text"])
+
+
+if __name__ == "__main__":
+    print("Running tests...")
+    unittest.main()